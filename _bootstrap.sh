@@ -50,7 +50,8 @@ fi
 
 $VENV/python -m pip install -r requirements.txt
 echo "*****************************************************************************************"
-echo "* AT STARTUP THE TOOL PARSES ALL BRANCHES. AT MAY TAKE A WHILE!                         *"
+echo "* AT STARTUP THE TOOL LOADS ALL BRANCHES IN THE BACKGROUND, WEBHOOKS ARE QUEUED MEANWHILE *"
+echo "* To follow the warm-up: http://127.0.0.1:6002/branch_protection/ready                  *"
 echo "*****************************************************************************************"
 echo "* To show the list of protected branches: http://127.0.0.1:6002/branch_protection/list  *"
 echo "* To force applying rules: http://127.0.0.1:6002/branch_protection/force_push_list      *"
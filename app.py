@@ -1,27 +1,86 @@
-from flask import Flask, request
+from flask import Flask, Response, request, g
+from flask.logging import default_handler
 import threading
-from multiprocessing import Pool, Process
 import logging
 from pathlib import Path
-import re
 import os
-import ast
-import requests
-import shutil
-from time import sleep, time
+from time import time, perf_counter
 import json
-import datetime
+import atexit
 from scripts import config
-from urllib.parse import quote
+from scripts.rules import BranchRules
+from scripts.branch_index import BranchIndex, SNAPSHOT_SUFFIX
+from scripts.http_client import get_client, last_page
+from scripts.response_cache import get_response_cache
+from scripts.scheduler import TaskScheduler, QueueFull
+from scripts.reconcile import ReconcileEngine, AdaptiveSchedule, ApiBudget
+from scripts.protection import diff_settings, payload_for
+from scripts.journal import EventJournal
+from scripts.dedup import DeliveryCache, Coalescer
+from scripts.discovery import OrgDiscovery, is_pattern, section_for
+from scripts.shared_store import SharedStore, SharedDeliveryCache, LeaderLock
+from scripts import listing
+from scripts.metrics import REGISTRY, cache_lookup
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import git
 
 log = logging.getLogger(__name__)
+PAGES_FETCHED = REGISTRY.counter("gitea_pages_fetched_total", "Listing pages fetched", ("repo", "listing"))
+REQUESTS = REGISTRY.counter("branch_protection_requests_total", "Requests served", ("endpoint", "status"))
+REQUEST_SECONDS = REGISTRY.histogram("branch_protection_request_seconds", "Latency of the requests served",
+                                     ("endpoint",))
+# Gitea API root, the trailing slash is expected
+API_URL = os.environ.get("GITEA_API_URL", "https://try.gitea.io/api/v1/").rstrip("/") + "/"
+# Snapshots older than this (in seconds) are refreshed from the API at startup, 0 to never expire
+SNAPSHOT_MAX_AGE = int(os.environ.get("BRANCH_SNAPSHOT_MAX_AGE", 86400))
+PAGE_SIZE = 100
+# Seconds between two reconciles of an idle repository (0 to disable them) and of the busiest ones,
+# and between two snapshot flushes
+RESYNC_INTERVAL = int(os.environ.get("BRANCH_RESYNC_INTERVAL", 3600))
+RECONCILE_MIN_INTERVAL = int(os.environ.get("RECONCILE_MIN_INTERVAL", 300))
+FLUSH_INTERVAL = int(os.environ.get("BRANCH_FLUSH_INTERVAL", 5))
+# A repository is reconciled about every RECONCILE_EVENTS webhook events, within the intervals above
+RECONCILE_EVENTS = int(os.environ.get("RECONCILE_EVENTS", 20))
+# Gitea calls the background reconciles may send each minute (0 for no limit), and whether they renew drifted settings
+RECONCILE_API_BUDGET = int(os.environ.get("RECONCILE_API_BUDGET", 600))
+RECONCILE_DRIFT = os.environ.get("RECONCILE_DRIFT", "true").lower() == "true"
+# Webhook events journal, rotated past JOURNAL_MAX_BYTES
+JOURNAL_FILE = os.environ.get("WEBHOOK_JOURNAL", "webhook.jsonl")
+JOURNAL_MAX_BYTES = int(os.environ.get("WEBHOOK_JOURNAL_MAX_BYTES", 50 * 1024 * 1024))
+JOURNAL_BACKUPS = int(os.environ.get("WEBHOOK_JOURNAL_BACKUPS", 5))
+JOURNAL_COMPRESS = os.environ.get("WEBHOOK_JOURNAL_COMPRESS", "true").lower() == "true"
+# Delivery ids remembered to drop Gitea retries, and seconds during which the events of a branch are merged
+DELIVERY_CACHE_SIZE = int(os.environ.get("DELIVERY_CACHE_SIZE", 10000))
+DELIVERY_CACHE_TTL = int(os.environ.get("DELIVERY_CACHE_TTL", 3600))
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 0.5))
+# Handlers built at the same time during the warm-up
+STARTUP_CONCURRENCY = int(os.environ.get("STARTUP_CONCURRENCY", 8))
+# Threads protecting branches, and tasks allowed to wait for them
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 8))
+SCHEDULER_MAX_PENDING = int(os.environ.get("SCHEDULER_MAX_PENDING", 10000))
+# Pages of one listing fetched at the same time
+PAGE_CONCURRENCY = int(os.environ.get("GITEA_PAGE_CONCURRENCY", 8))
+# Seconds between two writes of the listing pages cache to disk
+RESPONSE_CACHE_SAVE_INTERVAL = int(os.environ.get("GITEA_CACHE_SAVE_INTERVAL", 300))
+# Database shared by the worker processes of a multi-process deployment, empty for a single process,
+# seconds between two replays of the changes of the other workers, and seconds without a heartbeat after which
+# a worker is dead and its pending tasks are adopted
+SHARED_STORE = os.environ.get("SHARED_STORE", "")
+SHARED_SYNC_INTERVAL = float(os.environ.get("SHARED_SYNC_INTERVAL", 0.5))
+WORKER_TIMEOUT = int(os.environ.get("SHARED_WORKER_TIMEOUT", 30))
+# Seconds a worker which does not lead waits for the snapshots of a repository listed by the leader
+SNAPSHOT_WAIT = int(os.environ.get("SHARED_SNAPSHOT_WAIT", 300))
+# Seconds between two checks of the ini files, 0 to only reload them through /reload
+CONFIG_WATCH_INTERVAL = float(os.environ.get("CONFIG_WATCH_INTERVAL", 2))
+# Seconds between two scans of the organizations having glob sections, 0 to only scan at startup and reload
+DISCOVERY_INTERVAL = int(os.environ.get("DISCOVERY_INTERVAL", 600))
 
 
 class EndpointUrls:
     """Setting global endpoint accesses"""
     def __init__(self, organization, repository):
-        self.api_url = "https://try.gitea.io/api/v1/"
+        self.api_url = API_URL
         self.org_url = self.api_url + organization
         self.org_repo_list = self.api_url + "orgs/" + organization + "/repos"
         self.repo_url = self.api_url + "repos/" + organization + "/" + repository
@@ -32,7 +91,9 @@ class EndpointUrls:
         self.protected_branch = None
         self.teams_search = self.api_url + "orgs/teams/search"
         self._token = os.environ['GITEA_TOKEN']
-        self.url_token = "?token=" + self._token
+        # the token travels as a header so urls stay reusable and cacheable
+        self.headers = {"Authorization": "token " + self._token, "accept": "application/json"}
+        self.json_headers = dict(self.headers, **{"content-type": "application/json"})
         self.verify = self.set_verify()
 
     def set_verify(self):
@@ -45,9 +106,13 @@ class EndpointUrls:
     def set_branch(self, branch):
         """Will set a branch url"""
         self.branch = self.repo_branches + "/" + branch
+        self.protected_branch = self.protected_branch_url(branch)
+
+    def protected_branch_url(self, branch):
+        """Url of the protection of a branch, without touching the shared state"""
         # Beware of the special web characters :
         safe_branch = quote(branch, safe='')
-        self.protected_branch = self.repo_branches_protections + "/" + safe_branch
+        return self.repo_branches_protections + "/" + safe_branch
 
 
 class Failure(Exception):
@@ -59,95 +124,309 @@ class Failure(Exception):
             message(str): error message
             status_code(int): http status code
         """
-        Exception.__init__(self)
+        Exception.__init__(self, message)
         self.message = message
         self.status_code = status_code
 
 
-class BranchPush(threading.Thread):
-    """Use a thread to call a branch"""
-    def __init__(self, handler, branch):
-        threading.Thread.__init__(self)
+class BranchPush:
+    """Protection task of a branch, run by the scheduler
+
+    With a shared store the task is recorded there too, the same branch is never pending in two workers.
+    """
+    def __init__(self, handler, branch, store=None):
         self.handler = handler
         self.branch = branch
+        self.key = (handler.identity, branch)
+        self.store = store
+
+    def submit(self, scheduler, block=False, claimed=False):
+        """Queue the task, False if the same branch is already waiting"""
+        if self.store is not None and not claimed and not self.store.claim_task(*self.key):
+            return False
+        try:
+            queued = scheduler.submit(self.handler.identity, self.key, self.run, block=block)
+        except QueueFull:
+            self.release()
+            raise
+        if not queued:
+            self.release()
+        return queued
+
+    def release(self):
+        if self.store is not None:
+            self.store.release_task(*self.key)
 
     def run(self):
-        sleep(0.1)
-        self.handler.protect_branch(self.branch)
-        self.handler.update_branches()
+        try:
+            # an earlier task may have protected it since this one was queued
+            if self.handler.is_branch_protected(self.branch):
+                return
+            # protect_branch records the new protection, no need to list the repository again
+            self.handler.protect_branch(self.branch)
+        finally:
+            self.release()
 
 
-class BranchList(threading.Thread):
-    """Use a thread to call a branch"""
-    def __init__(self, handler):
-        threading.Thread.__init__(self)
-        self.handler = handler
+class SharedSync(threading.Thread):
+    """Replay the changes published by the other workers, and take the lead when the leader is gone
+
+    The leader also runs the tasks left pending by dead workers, and prunes the shared database.
+    """
+    def __init__(self, hooks, store, leader, scheduler, schedule, interval=SHARED_SYNC_INTERVAL):
+        threading.Thread.__init__(self, daemon=True, name="shared-sync")
+        self.hooks = hooks
+        self.store = store
+        self.leader = leader
+        self.scheduler = scheduler
+        self.schedule = schedule
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.replayed = 0
 
     def run(self):
-        self.handler.update_branches()
+        last_maintenance = last_beat = 0.0
+        while not self.stopped.wait(self.interval):
+            try:
+                if time() - last_beat >= WORKER_TIMEOUT / 3:
+                    self.store.beat()
+                    last_beat = time()
+                self.replay()
+                if self.leader.acquire() and time() - last_maintenance >= WORKER_TIMEOUT / 3:
+                    self.adopt()
+                    self.store.prune(events_age=3600, deliveries_age=DELIVERY_CACHE_TTL)
+                    last_maintenance = time()
+            except Exception as e:
+                log.warning("Cannot sync with the shared store : %s", e)
+
+    def replay(self):
+        for repository, kind, branch, data in self.store.changes():
+            if kind == "webhook":
+                self.schedule.observe(repository)
+                continue
+            if kind == "discovered":
+                # the leader found created or removed repositories in the organization
+                if repository in self.hooks.organizations:
+                    self.hooks.sync_organization(repository)
+                continue
+            handler = self.hooks.registry.get(repository)
+            if handler is not None:
+                handler.apply_change(kind, branch, data)
+            elif kind == "resynced" and repository in self.hooks.failed:
+                # the leader was not done listing it when this worker started : build it from its snapshots now
+                self.hooks.sync_organization(repository.split("/")[0], rescan=False)
+            if kind == "resynced":
+                self.hooks.notify_resynced()
+            self.replayed += 1
+
+    def adopt(self):
+        """Queue again the tasks the dead workers did not finish"""
+        for repository, branch in self.store.adopt_tasks(WORKER_TIMEOUT):
+            handler = self.hooks.registry.get(repository)
+            if handler is None:
+                self.store.release_task(repository, branch)
+                continue
+            log.info("Adopting the protection of %s on %s", branch, repository)
+            try:
+                BranchPush(handler, branch, self.store).submit(self.scheduler, claimed=True)
+            except QueueFull as e:
+                # released by submit : the next background reconcile of the repository protects the branch
+                log.warning("Cannot adopt %s on %s : %s", branch, repository, e)
+
+    def stats(self):
+        stats = self.store.stats()
+        stats.update({"leader": self.leader.held, "replayed": self.replayed})
+        return stats
+
+    def stop(self):
+        self.stopped.set()
+
+
+class BackgroundReconciler(threading.Thread):
+    """Reconcile every handler on its adaptive schedule, within the API budget, to catch the missed webhooks
+
+    Between two reconciles it writes the pending deltas to disk, saves the response cache
+    and scans the organizations for the repositories created or removed since.
+    """
+    def __init__(self, hooks, schedule, budget, force=RECONCILE_DRIFT, flush_interval=FLUSH_INTERVAL,
+                 discovery_interval=DISCOVERY_INTERVAL, leader=None):
+        threading.Thread.__init__(self, daemon=True, name="reconciler")
+        self.hooks = hooks
+        # with several workers only the one holding the leader lock reconciles and writes to disk
+        self.leader = leader
+        self.schedule = schedule
+        self.budget = budget
+        self.force = force
+        self.flush_interval = flush_interval
+        self.discovery_interval = discovery_interval
+        self.stopped = threading.Event()
+        self.reconciled = 0
+        self.protected = 0
+
+    def run(self):
+        last_discovery = last_cache_save = time()
+        while not self.stopped.wait(self.flush_interval):
+            if not self.leads():
+                # the leader shares what its scans found
+                continue
+            if self.discovery_interval and time() - last_discovery >= self.discovery_interval:
+                try:
+                    self.hooks.make_handlers()
+                except Exception as e:
+                    log.warning("Cannot scan the organizations : %s", e)
+                last_discovery = time()
+            if time() - last_cache_save >= RESPONSE_CACHE_SAVE_INTERVAL:
+                try:
+                    get_response_cache().flush()
+                except OSError as e:
+                    log.warning("Cannot save the response cache : %s", e)
+                last_cache_save = time()
+            if self.schedule.max_interval:
+                self.reconcile_due()
+            for handler in self.hooks.handlers:
+                try:
+                    handler.flush()
+                except Exception as e:
+                    log.warning("Cannot flush %s : %s", handler.identity, e)
+
+    def leads(self):
+        return self.leader is None or self.leader.held
+
+    def reconcile_due(self):
+        """Reconcile the repositories due, until the budget of the minute is spent"""
+        registry = dict(self.hooks.registry)
+        self.schedule.track(registry)
+        for identity in self.schedule.due():
+            if self.stopped.is_set():
+                return
+            handler = registry[identity]
+            # both listings, as many pages as last time
+            pages = sum(max(1, -(-len(index) // PAGE_SIZE)) for index in (handler.branches, handler.protected_branches))
+            wait = self.budget.take(pages)
+            if wait:
+                log.debug("API budget spent, %s reconciles postponed by %.1fs", identity, wait)
+                return
+            try:
+                self.reconcile(handler)
+            except Exception as e:
+                log.warning("Cannot reconcile %s : %s", identity, e)
+            # a failing repository waits a whole interval too, instead of using the budget up
+            self.schedule.done(identity)
+
+    def reconcile(self, handler):
+        """Resync a handler from the API, then protect the branches the webhooks missed"""
+        handler.update_branches()
+        engine = ReconcileEngine([handler], force=self.force)
+        actions = engine.plan()
+        self.reconciled += 1
+        if not actions:
+            return
+        self.budget.spend(len(actions))
+        report = engine.run(actions)
+        self.protected += report["created"] + report["patched"]
+        log.info("Reconciled %s : %s created, %s patched, %s failed", handler.identity, report["created"],
+                 report["patched"], report["failed"])
+
+    def stats(self):
+        return {"reconciled": self.reconciled, "protected": self.protected, "budget": self.budget.stats()}
+
+    def stop(self):
+        self.stopped.set()
 
 
 class RepositoryHandler:
     """ this doc"""
-    def __init__(self, organization, repository):
+    def __init__(self, organization, repository, section=None, store=None, lists=True):
         self.organization = organization
         self.repository = repository
-        self.parameters = config.ConfigReader(organization)
-        self.repo_parameters = self.parameters.config_get(repository)
+        # ini section of the repository, a glob section for the discovered ones
+        self.section = section or repository
+        self.load_config()
         self.urls = EndpointUrls(organization, repository)
-        self.branches = []
-        self.protected_branches = []
-        self.read_branches()
         self.identity = organization + "/" + repository
+        self.branches = BranchIndex()
+        self.protected_branches = BranchIndex()
+        # set when webhook deltas were applied but not written to disk yet
+        self.dirty = False
+        # where the changes are published for the other workers, and whether the API may be listed :
+        # a worker which does not lead reads the snapshots of the leader instead
+        self.store = store
+        self.lists = lists
+        self.read_branches()
+
+    def load_config(self, section=None):
+        """Read the ini section, and build the rules and the payload it describes
+
+        Nothing is changed if the section is invalid, the handler keeps its former rules.
+        """
+        section = section or self.section
+        parameters = config.ConfigReader(self.organization)
+        repo_parameters = parameters.config_get(section)
+        rules = BranchRules.from_config(repo_parameters)
+        # built and validated once, rebuilt only when the ini file changes
+        payload = payload_for(parameters, section)
+        self.section = section
+        self.parameters, self.repo_parameters, self.rules, self.payload = parameters, repo_parameters, rules, payload
+
+    def fetch_page(self, url, page):
+        """Grab one page of a listing, an unchanged page is revalidated and read from the response cache"""
+        params = {"per_page": PAGE_SIZE, "page": page}
+        log.debug("%s grabbed page %s of %s", self.identity, page, url)
+        # retries, backoff and rate limits are handled by the client
+        PAGES_FETCHED.inc(self.identity, "protections" if url == self.urls.repo_branches_protections else "branches")
+        return get_response_cache().get(url, params=params, headers=self.urls.headers, verify=self.urls.verify,
+                                        repo=self.identity)
 
     def get_branches(self, protected=False):
-        """Recover the protected branches"""
-        next_page_exists = True
-        page = 1
-        all_branches = []
-        count = 0
+        """Recover the branches, or the protected branches, streamed into an index as pages arrive
+
+        Raise Failure if any page cannot be read : a partial listing would drop the branches it misses.
+        """
+        index = BranchIndex()
         url = self.urls.repo_branches
-        to_append = "name"
+
+        def add(items):
+            index.update(item["name"] for item in items)
         if protected:
             url = self.urls.repo_branches_protections
-            url += self.urls.url_token
-            to_append = "branch_name"
-        while next_page_exists:
-            params = {"per_page": 100, "page": page}
-            print("{} grabbed page {}".format(self.repository, page))
-            # print('processing repo page {}'.format(page))
-            r = requests.get(url, params=params, verify=self.urls.verify)
-            json_branches = r.json()
-            if r.status_code != 200:
-                count += 1
-                # print("Incorrect status code - sleeping")
-                # print(r.text)
-                sleep(0.1)
-                if count == 3:
-                    # print("too much errors - skipping")
-                    next_page_exists = False
-            else:
-                # print(pull_api_url)
-                # print(r.links)
+
+            def add(items):
+                # keep the whole protection, to compare it with the rules later on
+                index.update_data((item["branch_name"], item) for item in items)
+        r = self.fetch_page(url, 1)
+        if r.status_code != 200:
+            raise Failure("Cannot list {} page 1 : {} {}".format(url, r.status_code, r.text), 502)
+        first_page = r.json()
+        add(first_page)
+        # the server may cap per_page, the first page tells the real size
+        page_count = last_page(r, len(first_page))
+        if page_count is None:
+            # no count available : follow the links one after the other
+            page = 1
+            while "next" in r.links:
                 page += 1
-                for branch in json_branches:
-                    all_branches.append(branch[to_append])
-                if page % 100 == 0:
-                    sleep(0.3)
-                    # print("prevent bottleneck")
-                if "next" not in r.links:
-                    next_page_exists = False
-                    # print('finished fetching branches')
-        return all_branches
+                r = self.fetch_page(url, page)
+                if r.status_code != 200:
+                    raise Failure("Cannot list {} page {} : {} {}".format(url, page, r.status_code, r.text), 502)
+                add(r.json())
+        elif page_count > 1:
+            with ThreadPoolExecutor(max_workers=min(PAGE_CONCURRENCY, page_count - 1)) as pool:
+                pages = {pool.submit(self.fetch_page, url, page): page for page in range(2, page_count + 1)}
+                for future in as_completed(pages):
+                    r = future.result()
+                    if r.status_code != 200:
+                        raise Failure("Cannot list {} page {} : {} {}".format(url, pages[future], r.status_code,
+                                                                              r.text), 502)
+                    add(r.json())
+        return index
 
     def is_branch_in_regex(self, ref_branch):
-        """Parse the regex in the config and compare it to a given branch"""
-        regexed_branches = ast.literal_eval(self.repo_parameters["branches"])
-        for regex in regexed_branches:
-            is_concerned = re.match(regex, ref_branch)
-            if is_concerned:
-                return True
-        return False
+        """Compare a given branch to the precompiled rules of the config"""
+        return self.rules.match(ref_branch)
+
+    def branches_in_regex(self):
+        """Return every known branch concerned by the rules"""
+        return self.rules.match_many(self.branches)
 
     def is_branch_protected(self, branch):
         if branch in self.protected_branches:
@@ -162,158 +441,482 @@ class RepositoryHandler:
             return False
 
     def update_branches(self):
-        """Will reupdate the file with new server status"""
-        self.branches = self.get_branches()
-        self.protected_branches = self.get_branches(protected=True)
+        """Will reupdate the file with new server status, both listings are fetched at the same time
+
+        The indexes are only replaced once both listings are complete, a failure keeps the previous ones.
+        """
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            branches = pool.submit(self.get_branches)
+            protected_branches = pool.submit(self.get_branches, protected=True)
+            branches, protected_branches = branches.result(), protected_branches.result()
+        self.branches = branches
+        self.protected_branches = protected_branches
         self.save_branches_to_file()
+        # the other workers read the new snapshots
+        self.publish("resynced")
+
+    def branch_created(self, branch):
+        """Record a branch seen in a push or create event"""
+        if branch not in self.branches:
+            self.branches.add(branch)
+            self.dirty = True
+            self.publish("created", branch)
+
+    def branch_deleted(self, branch):
+        """Record a delete event, the protection listing is left to the server (and the next resync)"""
+        if branch in self.branches:
+            self.branches.discard(branch)
+            self.dirty = True
+            self.publish("deleted", branch)
+
+    def branch_protected(self, branch, settings=None):
+        """Record a successful protection call, with the settings returned by the server"""
+        self.branches.add(branch)
+        self.protected_branches.add(branch, settings)
+        self.dirty = True
+        self.publish("protected", branch, settings)
+
+    def publish(self, kind, branch="", data=None):
+        """Share a change with the other workers, when there are"""
+        if self.store is not None:
+            self.store.publish(self.identity, kind, branch, data)
+
+    def apply_change(self, kind, branch, data=None):
+        """Replay a change published by another worker"""
+        if kind == "resynced":
+            self.load_snapshots()
+            return
+        if kind == "created":
+            self.branches.add(branch)
+        elif kind == "deleted":
+            self.branches.discard(branch)
+        elif kind == "protected":
+            self.branches.add(branch)
+            self.protected_branches.add(branch, data)
+        self.dirty = True
+
+    def flush(self):
+        """Write the snapshots if deltas were applied since the last save"""
+        if self.dirty:
+            self.dirty = False
+            self.save_branches_to_file()
+
+    def snapshot_filenames(self, extension=SNAPSHOT_SUFFIX):
+        """Names of the branches and protected branches snapshots"""
+        prefix = self.organization + "_" + self.repository
+        return prefix + "_branches" + extension, prefix + "_protected_branches" + extension
 
     def save_branches_to_file(self):
-        """Write protected branches to file"""
-        branches_filename = self.organization + "_" + self.repository + "_branches.txt"
-        protected_branches_filename = self.organization + "_" + self.repository + "_protected_branches.txt"
-        files = {branches_filename: self.branches, protected_branches_filename: self.protected_branches}
-        for file, to_save in files.items():
-            saving = open(file, "w")
-            print(to_save)
-            saving.write(str(to_save))
-            saving.close()
-            print("Written {} to disk".format(file))
-            sleep(0.5)
-        print("Saving done")
+        """Write branches and protected branches snapshots to disk"""
+        branches_filename, protected_branches_filename = self.snapshot_filenames()
+        self.branches.save(branches_filename)
+        self.protected_branches.save(protected_branches_filename)
+        log.debug("Written %s and %s to disk", branches_filename, protected_branches_filename)
+
+    def load_snapshots(self):
+        """Load both snapshots, migrating the former text files if needed. Return False if missing"""
+        branches_filename, protected_branches_filename = self.snapshot_filenames()
+        try:
+            self.branches = BranchIndex.load(branches_filename)
+            self.protected_branches = BranchIndex.load(protected_branches_filename)
+            return True
+        except (OSError, ValueError) as e:
+            log.info("No usable snapshot for %s : %s", self.identity, e)
+        legacy_filenames = self.snapshot_filenames(".txt")
+        try:
+            self.branches = BranchIndex.load_legacy(legacy_filenames[0])
+            self.protected_branches = BranchIndex.load_legacy(legacy_filenames[1])
+        except (OSError, ValueError, SyntaxError):
+            return False
+        self.save_branches_to_file()
+        for legacy_filename in legacy_filenames:
+            os.remove(legacy_filename)
+        return True
 
     def read_branches(self):
-        """Reading branches from file"""
-        print("Checking branches")
-        branches_filename = self.organization + "_" + self.repository + "_branches.txt"
-        protected_branches_filename = self.organization + "_" + self.repository + "_protected_branches.txt"
-        already_loaded = os.path.isfile(branches_filename)
-        already_loaded_protected = os.path.isfile(protected_branches_filename)
-        if not already_loaded or not already_loaded_protected:
-            print("Getting branches")
-            self.update_branches()
-            # print(self.branches)
-            # print(self.protected_branches)
-            self.save_branches_to_file()
-        print("Reading files")
-        files = {branches_filename: self.branches, protected_branches_filename: self.protected_branches}
-        for file in files.keys():
-            reading = open(file, "r")
-            to_read = reading.readlines()[0]
-            files[file] = to_read
-            # to_read = ast.literal_eval(read_file)
-            print("Read {} from disk".format(file))
-            print("found ", to_read)
-            reading.close()
-        self.branches = files[branches_filename]
-        self.protected_branches = files[protected_branches_filename]
-        if self.branches == "" or self.branches == []:
-            print("!! EMPTY BRANCHES !!")
+        """Reading branches from snapshots, the API is only called when they are missing or stale"""
+        loaded = self.load_snapshots()
+        fresh = loaded and self.branches.is_fresh(SNAPSHOT_MAX_AGE)
+        cache_lookup("snapshot", fresh)
+        if not fresh and not self.lists:
+            if not loaded:
+                raise Failure("No snapshot of {} yet, the leader lists it".format(self.identity), 503)
+        elif not fresh:
+            log.info("Getting branches of %s from the API", self.identity)
             try:
-                print('removing Files')
-                os.remove(branches_filename)
-                os.remove(protected_branches_filename)
+                self.update_branches()
+            except Failure as e:
+                if not loaded:
+                    raise
+                log.warning("Keeping the stale snapshots of %s : %s", self.identity, e.message)
+        log.info("Read %s branches, %s protected for %s",
+                 len(self.branches), len(self.protected_branches), self.identity)
+        if not self.branches:
+            log.error("!! EMPTY BRANCHES !! removing the snapshots of %s", self.identity)
+            try:
+                for filename in self.snapshot_filenames():
+                    os.remove(filename)
             except Exception as e:
-                print('Cannot reset configuration {}'.format(e))
-            print("Missing branches - Check {} Repository {}".format(self.organization, self.repository))
+                log.error('Cannot reset configuration %s', e)
+            log.error("Missing branches - Check %s Repository %s", self.organization, self.repository)
             raise Failure("failed", 500)
 
+    def protection_diff(self, branch):
+        """Settings of the branch which differ from the rules, empty when the server is up to date"""
+        return diff_settings(self.payload.settings, self.protected_branches.get(branch))
+
+    def needs_protection(self, branch, force=False):
+        """True if the branch is not protected, or (when forcing) if its protection differs from the rules"""
+        if not self.is_branch_protected(branch):
+            return True
+        return force and bool(self.protection_diff(branch))
+
     def protect_branch(self, branch):
         """ Make an api call to protect the branch"""
-        # set the dictionary with parameters
-        action_dict = {}
-        for k, v in self.repo_parameters.items():
-            if k != "branches":
-                try:
-                    action_dict[k] = ast.literal_eval(v)
-                except ValueError:
-                    # ensure Json boolean
-                    if v == "true":
-                        action_dict[k] = True
-                    elif v == "false":
-                        action_dict[k] = False
-                    else:
-                        action_dict[k] = v
-        action_dict["branch_name"] = branch
-        # set the specifics for this branch
-        self.urls.set_branch(branch)
-        action = requests.post
+        # the body is serialized once per repository, only the branch name is added
+        client = get_client()
+        action = client.post
         url = self.urls.repo_branches_protections
+        body = self.payload.post_body(branch)
         # if we need to modify the branch protection then set up another url
         if self.is_branch_protected(branch):
-            action = requests.patch
-            url = self.urls.protected_branch
-            # if the protection exists, we don't need this key
-            action_dict.pop("branch_name")
-        url += self.urls.url_token
-        headers = {'content-type': 'application/json', 'accept': 'application/json'}
-        r = action(url, data=json.dumps(action_dict), headers=headers, verify=self.urls.verify)
+            action = client.patch
+            url = self.urls.protected_branch_url(branch)
+            # if the protection exists, we don't need the branch name
+            body = self.payload.patch_body
+        r = action(url, data=body, headers=self.urls.json_headers, verify=self.urls.verify, repo=self.identity)
         # Should get a 201
         correct_answer = [200, 201]
         if r.status_code not in correct_answer:
-            print("ERROR")
-            print(r.url)
-            print(r.status_code)
-            print(r.text)
-            print(action_dict)
-            print("----------------")
+            log.error("Cannot protect %s on %s : %s %s %s\n%s", branch, self.identity, r.url, r.status_code, r.text, body)
             raise Failure(r.text, r.status_code)
         else:
-            print("{} protected on {}".format(branch, self.identity))
-            # self.protected_branches.append(branch)
-            # self.branches.append(branch)
+            log.debug("%s protected on %s", branch, self.identity)
+            try:
+                settings = r.json()
+            except ValueError:
+                settings = None
+            self.branch_protected(branch, settings if isinstance(settings, dict) else None)
 
 
 class FlaskHook:
-    def __init__(self):
+    """Registry of the repository handlers, built concurrently from the snapshots
+
+    With background set, the constructor returns at once and the handlers are warmed up on a bounded pool,
+    the events of a repository still warming up are deferred until its handler is ready.
+    """
+    def __init__(self, background=False, store=None, leader=None):
+        self.background = background
+        # with several workers only the leader lists the organizations and the repositories
+        self.store = store
+        self.leader = leader
+        self.resynced = threading.Condition()
         self.base = os.getcwd()
         self.organizations = []
         self.repositories = {}
-        self.handlers = []
-        self.indexes = []
+        # org/repo -> handler, and org/repo -> content of its ini section when the handler was built
+        self.registry = {}
+        self.signatures = {}
+        # organization -> repository listing, for the organizations having glob sections
+        self.discoveries = {}
+        self.lock = threading.Lock()
+        # organization -> future of its first sync, org/repo -> future of the handler being built,
+        # and callbacks waiting for it
+        self.scanning = {}
+        self.building = {}
+        self.waiting = {}
+        self.failed = {}
+        self.deferred = 0
+        self.started_at = time()
+        self.ready_at = None
+        self.executor = ThreadPoolExecutor(max_workers=STARTUP_CONCURRENCY, thread_name_prefix="warmup")
         self.find_organizations()
-        self.make_handlers()
-        self.thread_list = []
+        self.make_handlers(background)
+        if not background:
+            self.wait_ready()
+
+    @property
+    def handlers(self):
+        return list(self.registry.values())
+
+    @property
+    def indexes(self):
+        return list(self.registry)
 
     def find_organizations(self):
         """Find ini files and populate"""
-        print("found organizations : ")
         for file in Path(self.base).glob('**/*.ini'):
-            print(file.name)
+            log.info("found organization %s", file.name)
             self.organizations.append(file.stem)
 
-    def reset(self):
-        self.__init__()
-
     @staticmethod
     def populate_repository(organization):
         org_config = config.ConfigReader(organization)
         org_config.config_read()
-        return org_config.sections
+        return org_config
 
-    def make_handlers(self):
+    def make_handlers(self, background=False):
+        """Build the handlers of every organization, only the changed ones are rebuilt
+
+        With background the organizations are synced on the warm-up pool : listing those having glob sections
+        does not hold the caller.
+        """
         for org in self.organizations:
-            self.repositories[org] = self.populate_repository(org)
-        for key, value in self.repositories.items():
-            for v in value:
-                self.handlers.append(RepositoryHandler(key, v))
-        for handler in self.handlers:
-            self.indexes.append(handler.identity)
-
-    def refresh_handler(self, organization, full_name):
-        self.repositories[organization] = self.populate_repository(organization)
-        for key, value in self.repositories.items():
-            for v in value:
-                self.handlers.append(RepositoryHandler(key, v))
-        for handler in self.handlers:
-            self.indexes.append(handler.identity)
+            if background:
+                with self.lock:
+                    self.scanning[org] = self.executor.submit(self.scan_organization, org)
+            else:
+                # one ini file which cannot be read only holds its own organization back
+                try:
+                    self.sync_organization(org)
+                except Exception as e:
+                    log.error("Cannot build the handlers of %s : %s", org, e)
+        with self.lock:
+            for identity in list(self.registry):
+                if self.registry[identity].organization not in self.organizations:
+                    self.forget(identity)
+
+    def scan_organization(self, organization):
+        """Sync an organization on the warm-up pool, then drop the events deferred for repositories it does not have"""
+        try:
+            self.sync_organization(organization)
+        except Exception as e:
+            log.error("Cannot build the handlers of %s : %s", organization, e)
+        with self.lock:
+            self.scanning.pop(organization, None)
+            for identity in list(self.waiting):
+                if identity.split("/")[0] == organization and identity not in self.building:
+                    log.warning("Dropping %s events for %s, it is not configured", len(self.waiting[identity]),
+                                identity)
+                    self.waiting.pop(identity)
+            self.check_ready()
+
+    def discover(self, organization):
+        """Repositories of an organization listed by the API, the listing is revalidated with its ETags
+
+        The leader shares its listing through the store, the other workers read it instead of scanning.
+        """
+        if self.follows():
+            return self.store.listing(organization) or []
+        discovery = self.discoveries.get(organization)
+        if discovery is None:
+            urls = EndpointUrls(organization, "")
+            discovery = self.discoveries[organization] = OrgDiscovery(
+                organization, urls.org_repo_list, urls.headers, verify=urls.verify, concurrency=PAGE_CONCURRENCY
+            )
+        repositories = discovery.scan()
+        # a failed first scan is not shared, the other workers keep their repositories
+        if self.store is not None and discovery.repositories is not None \
+                and self.store.share_listing(organization, repositories):
+            self.store.publish(organization, "discovered")
+        return repositories
+
+    def wanted_repositories(self, organization, sections, rescan=True):
+        """repository -> ini section, the glob sections apply to the repositories found in the organization
+
+        Without rescan the last listing of the organization is used, when there is one.
+        """
+        wanted = {section: section for section in sections if not is_pattern(section)}
+        if any(is_pattern(section) for section in sections):
+            discovery = self.discoveries.get(organization)
+            if not rescan and discovery is not None and discovery.repositories is not None:
+                repositories = list(discovery.repositories)
+            else:
+                repositories = self.discover(organization)
+            for repository in repositories:
+                if repository not in wanted:
+                    section = section_for(sections, repository)
+                    if section is not None:
+                        wanted[repository] = section
+        return wanted
+
+    def sync_organization(self, organization, rescan=True):
+        """Add, rebuild or remove the handlers of an organization to match its ini file, return what changed"""
+        org_config = self.populate_repository(organization)
+        self.repositories[organization] = org_config.sections
+        # the listing is read before taking the lock, webhooks keep being served meanwhile
+        repositories = self.wanted_repositories(organization, org_config.sections, rescan)
+        changes = {"added": [], "rebuilt": [], "removed": [], "errors": {}}
+        with self.lock:
+            wanted = set()
+            for repository, section in repositories.items():
+                identity = organization + "/" + repository
+                wanted.add(identity)
+                signature = (section,) + tuple(org_config.config.items(section))
+                if self.signatures.get(identity) == signature:
+                    continue
+                handler = self.registry.get(identity)
+                if handler is not None:
+                    # same repository, new rules : keep the known branches
+                    try:
+                        handler.load_config(section)
+                    except Exception as e:
+                        log.error("Keeping the former rules of %s : %s", identity, e)
+                        changes["errors"][identity] = str(e)
+                        continue
+                    changes["rebuilt"].append(identity)
+                elif identity not in self.building:
+                    self.failed.pop(identity, None)
+                    self.building[identity] = self.executor.submit(self.build, organization, repository, section)
+                    changes["added"].append(identity)
+                else:
+                    # built with the former section : the next sync rebuilds it with this one
+                    continue
+                self.signatures[identity] = signature
+            for identity in list(self.registry):
+                if self.registry[identity].organization == organization and identity not in wanted:
+                    self.forget(identity)
+                    changes["removed"].append(identity)
+        return changes
+
+    def reload(self, changed=(), removed=()):
+        """Apply the changed and removed ini files, the handlers of the other organizations are left untouched
+
+        The snapshots are kept : a new rule is a rebuilt handler, not a new listing of the repository.
+        """
+        summary = {"changed": list(changed), "deleted": list(removed), "added": [], "rebuilt": [], "removed": [],
+                   "errors": {}}
+        for organization in removed:
+            if organization in self.organizations:
+                self.organizations.remove(organization)
+            self.repositories.pop(organization, None)
+            self.discoveries.pop(organization, None)
+            with self.lock:
+                for identity in list(self.registry):
+                    if self.registry[identity].organization == organization:
+                        self.forget(identity)
+                        summary["removed"].append(identity)
+        for organization in changed:
+            if organization not in self.organizations:
+                self.organizations.append(organization)
+            try:
+                changes = self.sync_organization(organization, rescan=False)
+            except Exception as e:
+                # an ini file which cannot be parsed keeps the handlers of its former content
+                log.error("Cannot reload %s : %s", organization, e)
+                summary["errors"][organization] = str(e)
+                continue
+            for key in ("added", "rebuilt", "removed"):
+                summary[key].extend(changes[key])
+            summary["errors"].update(changes["errors"])
+        return summary
+
+    def build(self, organization, repository, section=None):
+        """Build a handler on the warm-up pool, then run the events deferred for it"""
+        identity = organization + "/" + repository
+        try:
+            handler = self.build_handler(organization, repository, section)
+        except Exception as e:
+            # a Failure keeps its reason in message
+            reason = getattr(e, "message", str(e))
+            log.error("Cannot build %s : %s", identity, reason)
+            with self.lock:
+                self.building.pop(identity, None)
+                self.signatures.pop(identity, None)
+                self.failed[identity] = reason
+                dropped = self.waiting.pop(identity, [])
+                self.check_ready()
+            if dropped:
+                log.warning("Dropping %s events deferred for %s", len(dropped), identity)
+            return None
+        with self.lock:
+            self.building.pop(identity, None)
+            if identity not in self.signatures:
+                # its section was removed while it was built
+                self.waiting.pop(identity, None)
+                self.check_ready()
+                return None
+            self.registry[identity] = handler
+            callbacks = self.waiting.pop(identity, [])
+            self.check_ready()
+        for callback in callbacks:
+            try:
+                callback(handler)
+            except Exception as e:
+                log.error("Deferred event on %s failed : %s", identity, e)
+        return handler
+
+    def build_handler(self, organization, repository, section=None):
+        """New handler ; a worker which does not lead waits for the snapshots the leader writes, up to SNAPSHOT_WAIT
+
+        When they are still missing the build fails, it is run again once the leader publishes the resync.
+        """
+        deadline = time() + SNAPSHOT_WAIT
+        while True:
+            following = self.follows()
+            try:
+                handler = RepositoryHandler(organization, repository, section, store=self.store, lists=not following)
+                if not following or handler.branches.is_fresh(SNAPSHOT_MAX_AGE) or time() >= deadline:
+                    return handler
+            except Failure:
+                if not following or time() >= deadline:
+                    raise
+            with self.resynced:
+                while self.follows() and time() < deadline and not self.resynced.wait(min(1.0, deadline - time())):
+                    pass
+
+    def follows(self):
+        """True in a worker of a multi-process deployment which leaves the API listings to the leader"""
+        return self.leader is not None and not self.leader.held
+
+    def notify_resynced(self):
+        """Wake the builds waiting for the snapshots of the leader"""
+        with self.resynced:
+            self.resynced.notify_all()
+
+    def check_ready(self):
+        """Record the end of the warm-up, called with the lock held"""
+        if not self.building and not self.scanning and self.ready_at is None:
+            self.ready_at = time()
+            log.info("%s handlers ready in %.1fs", len(self.registry), self.ready_at - self.started_at)
+
+    def wait_ready(self):
+        """Block until every handler is built"""
+        while True:
+            with self.lock:
+                futures = list(self.scanning.values()) + list(self.building.values())
+            if not futures:
+                return
+            for future in futures:
+                future.result()
+
+    def defer(self, identity, callback):
+        """Run callback(handler) once the handler of identity is built, False if the repository is not configured"""
+        with self.lock:
+            handler = self.registry.get(identity)
+            if handler is None:
+                if identity not in self.building and identity.split("/")[0] not in self.scanning:
+                    return False
+                self.waiting.setdefault(identity, []).append(callback)
+                self.deferred += 1
+                return True
+        callback(handler)
+        return True
+
+    def progress(self):
+        """Warm-up state, for the readiness endpoint"""
+        with self.lock:
+            building = len(self.building)
+            return {
+                "ready": building == 0 and not self.scanning,
+                "scanning": sorted(self.scanning),
+                "configured": len(self.registry) + building + len(self.failed),
+                "built": len(self.registry),
+                "building": building,
+                "failed": dict(self.failed),
+                "deferred_events": self.deferred,
+                "waiting_events": sum(len(callbacks) for callbacks in self.waiting.values()),
+                "warmup_seconds": round((self.ready_at or time()) - self.started_at, 3),
+            }
+
+    def forget(self, identity):
+        log.info("Removing %s", identity)
+        self.registry.pop(identity, None)
+        self.signatures.pop(identity, None)
 
     def is_in_indexes(self, full_name):
-        if full_name in self.indexes:
-            for handler in self.handlers:
-                if handler.identity == full_name:
-                    return True, handler
-        else:
-            return False, None
+        handler = self.registry.get(full_name)
+        return handler is not None, handler
 
 
 def create_app():
@@ -323,87 +926,166 @@ def create_app():
         flask.App: A flask application instance.
     """
     app = Flask(__name__, instance_relative_config=False)
-    app.logger.setLevel(logging.INFO)  # pylint: disable=no-member
+    app.logger.setLevel(os.environ.get("LOGLEVEL", "INFO"))  # pylint: disable=no-member
+    # app.logger is the logger of this module : the root handler below prints its records once
+    app.logger.removeHandler(default_handler)  # pylint: disable=no-member
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
     # app.run(host='0.0.0.0', port=6001, threaded=True, debug=False)
-    # log = logging.getprint(__name__)
-    hooks = FlaskHook()
-    task_list = []
-    print("Waiting input")
-    # print("Waiting input")
-
-    def update_handlers():
-        handlers_update = []
-        for handler in hooks.handlers:
-            handlers_update.append(BranchList(handler))
-        for thread in handlers_update:
-            thread.start()
-        for thread in handlers_update:
-            thread.join()
-        hooks.make_handlers()
-
-    def threads_works():
-        """Empty the tasks"""
-        if len(task_list) > 0:
-            for thread in task_list:
-                if not thread.is_alive():
-                    try:
-                        thread.start()
-                    except Exception as e:
-                        print("Thread already started probably {}".format(e))
-        while len(task_list) > 0:
-            for thread in task_list:
-                thread.join()
-            for thread in task_list:
-                task_list.remove(thread)
+    # opened before the handlers are built : the changes published meanwhile are replayed on top of the snapshots
+    store = leader = sync = None
+    if SHARED_STORE:
+        store = SharedStore(SHARED_STORE)
+        leader = LeaderLock(SHARED_STORE + ".lock")
+        leader.acquire()
+    # the files read by the handlers are the baseline : an edited ini file only rebuilds its changed sections
+    watcher = config.ConfigWatcher(os.getcwd(), lambda changed, removed: hooks.reload(changed, removed),
+                                   interval=CONFIG_WATCH_INTERVAL)
+    hooks = FlaskHook(background=True, store=store, leader=leader)
+    if CONFIG_WATCH_INTERVAL:
+        watcher.start()
+    scheduler = TaskScheduler(workers=SCHEDULER_WORKERS, max_pending=SCHEDULER_MAX_PENDING).start()
+    schedule = AdaptiveSchedule(min_interval=min(RECONCILE_MIN_INTERVAL, RESYNC_INTERVAL), max_interval=RESYNC_INTERVAL,
+                                events_per_reconcile=RECONCILE_EVENTS)
+    reconciler = BackgroundReconciler(hooks, schedule, ApiBudget(RECONCILE_API_BUDGET), leader=leader)
+    reconciler.start()
+    # a warm restart revalidates the pages instead of downloading them again
+    atexit.register(lambda: reconciler.leads() and get_response_cache().flush())
+    journal_file = JOURNAL_FILE
+    deliveries = DeliveryCache(max_size=DELIVERY_CACHE_SIZE, ttl=DELIVERY_CACHE_TTL)
+    if store is not None:
+        sync = SharedSync(hooks, store, leader, scheduler, schedule)
+        sync.start()
+        deliveries = SharedDeliveryCache(store, ttl=DELIVERY_CACHE_TTL)
+        # one journal per worker, the rotations of two processes would collide
+        journal_file = "{}.{}".format(JOURNAL_FILE, os.getpid())
+    journal = EventJournal(journal_file, max_bytes=JOURNAL_MAX_BYTES, backups=JOURNAL_BACKUPS,
+                           compress=JOURNAL_COMPRESS)
+    coalescer = Coalescer(window=COALESCE_WINDOW)
+    REGISTRY.gauge("branch_protection_task_queue_depth", "Protection tasks waiting or running",
+                   callback=scheduler.depth)
+    REGISTRY.gauge("branch_protection_coalescer_waiting", "Branch events held by the coalescing window",
+                   callback=lambda: len(coalescer.pending))
+    REGISTRY.gauge("branch_protection_handlers", "Repository handlers built", callback=lambda: len(hooks.registry))
+
+    @app.before_request
+    def start_timer():  # pylint: disable=unused-variable
+        g.started = perf_counter()
+
+    @app.after_request
+    def record_latency(response):  # pylint: disable=unused-variable
+        started = g.get("started")
+        if started is not None:
+            endpoint = request.endpoint or "unknown"
+            REQUEST_SECONDS.observe(perf_counter() - started, endpoint)
+            REQUESTS.inc(endpoint, str(response.status_code))
+        return response
+    log.info("Waiting input")
+
+    def handle_branch_event(handler, event, repo_branch, push_type):
+        """Apply a branch event to its handler, and queue the protection if needed
+
+        Run by the coalescer (or once the handler is built) after the webhook answered : the room was checked
+        by the webhook, waiting for it here slows the coalescer down, and the webhooks answer 503 meanwhile.
+        """
+        # a push whose new head is the null sha removes the branch
+        if event == "delete" or (push_type and not push_type.strip("0")):
+            handler.branch_deleted(repo_branch)
+            return "200 - OK"
+        handler.branch_created(repo_branch)
+        watch = handler.is_branch_in_regex(repo_branch)
+        if watch is True:
+            if repo_branch not in handler.protected_branches:
+                try:
+                    BranchPush(handler, repo_branch, store).submit(scheduler, block=True)
+                except QueueFull as e:
+                    log.error("Cannot queue %s on %s : %s", repo_branch, handler.identity, e)
+                    return "503 - Busy", 503
+                log.info("Appending %s to the protection %s", repo_branch, handler.identity)
+        return "200 - OK"
+
+    def dispatch_branch_event(full_name, event, repo_branch, push_type):
+        """Send a branch event to its handler, or defer it while the handler warms up"""
+        check, handler = hooks.is_in_indexes(full_name)
+        if check is True:
+            return handle_branch_event(handler, event, repo_branch, push_type)
+        if hooks.defer(full_name, lambda built: handle_branch_event(built, event, repo_branch, push_type)):
+            log.info("Deferring %s on %s until it is ready", repo_branch, full_name)
+        return "200 - OK"
+
+    @app.route('/branch_protection/ready', methods=['GET'])
+    def ready():  # pylint: disable=unused-variable
+        """Warm-up progress, 503 until every handler is built"""
+        progress = hooks.progress()
+        return json.dumps(progress), 200 if progress["ready"] else 503
 
     @app.route('/branch_protection/list', methods=['GET'])
     def list_repo():
-        """Display config file"""
-        pretty_print = {}
-        for handler in hooks.handlers:
-            pretty_print[handler.identity] = handler.protected_branches
-        return json.dumps(pretty_print)
+        """Protected branches per repository, streamed
+
+        Filtered by ?org=, ?repo= and ?prefix=, paginated by ?limit= branches (the next page is in the Link header),
+        and with ?status=1 the reconcile schedule of every repository too. An unchanged listing is answered 304.
+        """
+        try:
+            cursor = listing.decode_cursor(request.args["cursor"]) if request.args.get("cursor") else None
+            limit = int(request.args["limit"]) if request.args.get("limit") else None
+        except ValueError as e:
+            return "400 - {}".format(e), 400
+        if limit is not None and limit < 1:
+            return "400 - limit must be positive", 400
+        handlers = listing.select(hooks.handlers, request.args.get("org"), request.args.get("repo"))
+        statuses = None
+        if request.args.get("status"):
+            statuses = {handler.identity: schedule.status(handler.identity) for handler in handlers}
+        etag = listing.etag(handlers, request.query_string, statuses)
+        headers = {"ETag": '"{}"'.format(etag)}
+        if request.if_none_match.contains(etag):
+            return "", 304, headers
+        pages, next_cursor = listing.page(handlers, request.args.get("prefix", ""), cursor, limit)
+        if next_cursor is not None:
+            following = dict(request.args.items(), cursor=listing.encode_cursor(*next_cursor))
+            headers["Link"] = '<{}?{}>; rel="next"'.format(request.base_url, urlencode(following))
+        return Response(listing.stream(pages, statuses), mimetype="application/json", headers=headers)
 
     @app.route('/branch_protection/push_list', methods=['GET'])
     def push_repo():
         """Push every repo in the config list - do not alter existing branches"""
-        for handler in hooks.handlers:
-            for branch in handler.branches:
-                if handler.is_branch_in_regex(branch) and not handler.is_branch_protected(branch):
-                    task_list.append(BranchPush(handler, branch))
-        threads_works()
-        update_handlers()
-        print("Please reload the script : http://yourport:yoururl/branch_protection/reload ")
-        return "200 - {}".format("mirror")
+        if not hooks.progress()["ready"]:
+            return "503 - Warming up, see /branch_protection/ready", 503
+        engine = ReconcileEngine(hooks.handlers)
+        if request.args.get("dry_run"):
+            return json.dumps(engine.dry_run())
+        return json.dumps(engine.run())
 
     @app.route('/branch_protection/force_push_list', methods=['GET'])
     def force_push_repo():
-        """Force push every repo in the config list - alter existing branches so that they renew protection"""
-        for handler in hooks.handlers:
-            for branch in handler.branches:
-                if handler.is_branch_in_regex(branch):
-                    task_list.append(BranchPush(handler, branch))
-        threads_works()
-        print("Please reload the script : http://yourport:yoururl/branch_protection/reload ")
-        update_handlers()
-        return "200 - {}".format("mirror")
+        """Force push every repo in the config list - renew the protections which differ from the rules"""
+        if not hooks.progress()["ready"]:
+            return "503 - Warming up, see /branch_protection/ready", 503
+        engine = ReconcileEngine(hooks.handlers, force=True)
+        if request.args.get("dry_run"):
+            return json.dumps(engine.dry_run())
+        return json.dumps(engine.run())
 
     @app.route('/branch_protection/reload', methods=['GET'])
     def reload_repo():
-        """Reload the full class"""
-        actual_project = git.Repo("")
-        actual_project.git.reset('--hard')
-        pull_project = actual_project.remotes.origin
-        pull_project.pull()
-        actual_project.git.reset('--hard')
-        for file in Path().glob('**/*.txt'):
-            print("deleting {}".format(file.name))
-            os.remove(file)
-        hooks.reset()
-        # exit("0")
-        return '200 - Reread'
+        """Pull the config (fast-forward only, ?pull=0 to skip it), then reload the ini files which changed
+
+        Only the handlers of the changed sections are added, rebuilt or removed, the snapshots are kept.
+        """
+        started = perf_counter()
+        pulled = None
+        if request.args.get("pull", "1") != "0":
+            try:
+                git.Repo("").remotes.origin.pull(ff_only=True)
+                pulled = True
+            except Exception as e:
+                log.warning("Cannot pull the config, reloading the local files : %s", e)
+                pulled = False
+        summary = hooks.reload(*watcher.poll())
+        summary["pulled"] = pulled
+        summary["elapsed"] = round(perf_counter() - started, 3)
+        return json.dumps(summary)
 
     @app.route('/branch_protection/webhook', methods=['GET', 'POST'])
     def webhook():  # pylint: disable=unused-variable
@@ -411,69 +1093,79 @@ def create_app():
         Returns:
             flask.Response: An http response
         """
-        # print("incoming request")
-        null_value = "0" * 16
         if request.method == "GET":
-            threads_works()
             return '200 OK'
         if request.method == 'POST':
-            file = open("webhook.txt", 'a')
-            # threads_works()
             request_json = request.get_json()
             headers = request.headers
-            file.write(str(request_json))
-            file.write("\n")
-            file.write(str(headers))
-            file.write("\n")
-            file.close()
-            try:
-                print(headers.get("X-Gitea-Event"))
-            except Exception as e:
-                print(e)
+            # written by a background thread, the request never waits for the disk
+            journal.record(headers, request_json)
             repo_http_url = full_name = repo_branch = repo_name = ""
             push_type = None
             before = None
             try:
-                print("Incoming POST")
                 repo_http_url = request_json[u'repository'][u'html_url']
                 full_name = request_json[u'repository'][u'full_name']
-                repo_branch = request_json[u'ref'].replace("refs/heads/", "")
+                ref = request_json[u'ref']
+                repo_branch = ref.replace("refs/heads/", "")
                 repo_name = request_json[u'repository'][u'name']
-                if "u'after'" in request_json.keys():
+                if u'after' in request_json:
                     push_type = request_json[u'after']
-                if "u'before'" in request_json.keys():
+                if u'before' in request_json:
                     before = request_json[u'before']
 
                 event = headers.get("X-Gitea-Event")
-                str_obj = "{}, {}, {}, {}, {}".format(
-                    str(repo_name),
-                    str(full_name),
-                    str(repo_branch),
-                    str(repo_http_url),
-                    str(push_type)
-                )
-                log.info(str_obj)
+                # tags are pushed as refs/tags/..., created and deleted with ref_type "tag"
+                is_branch = ref.startswith("refs/heads/") if event == "push" else \
+                    request_json.get(u'ref_type', "branch") == "branch"
+                log.debug("%s event : %s, %s, %s, %s, %s", event, repo_name, full_name, repo_branch, repo_http_url,
+                          push_type)
             except KeyError as e:
-                log.error("Webhook not expecting this post \n {}".format(e))
+                log.error("Webhook not expecting this post \n %s", e)
                 return "500 - Not expected"
             else:
-                check, handler = hooks.is_in_indexes(full_name)
-                if check is True:
-                    watch = handler.is_branch_in_regex(repo_branch)
-                    # log.info(push_type, before)
-                    # log.info(before)
-                    # log.info(repo_branch)
-                    # log.info(handler)
-                    if watch is True:
-                        # print("Will add {}".format(repo_branch))
-                        if repo_branch not in handler.protected_branches and event != "delete":
-                            task_list.append(BranchPush(handler, repo_branch))
-                            log.info("Appending {} to the protection {}".format(repo_branch, handler.identity))
-                    p = Process(target=lambda: threads_works())
-                    p.start()
-                    # Grab deleted ones
+                if not is_branch:
+                    return "200 - OK"
+                # checked before answering : the event is applied later, by the coalescer thread
+                if not scheduler.has_room(len(coalescer.pending)):
+                    return "503 - Busy", 503
+                # Gitea retries a delivery with the same id
+                delivery = headers.get("X-Gitea-Delivery")
+                if deliveries.seen(delivery):
+                    log.info("Dropping retried delivery %s", delivery)
+                    return "200 - Duplicate"
+                # only the last event of a branch received during the window is applied
+                coalesced = coalescer.submit(
+                    (full_name, repo_branch),
+                    lambda: dispatch_branch_event(full_name, event, repo_branch, push_type)
+                )
+                if not coalesced:
+                    # refused : the retry of Gitea must not be taken for a duplicate
+                    deliveries.forget(delivery)
+                    return "503 - Busy", 503
+                # busy repositories are reconciled more often, by the leader when there are several workers
+                schedule.observe(full_name)
+                if store is not None:
+                    store.publish(full_name, "webhook")
                 return "200 - OK"
 
+    @app.route('/branch_protection/tasks', methods=['GET'])
+    def tasks():  # pylint: disable=unused-variable
+        """Queue depth and latency of the protection tasks"""
+        stats = scheduler.snapshot()
+        stats["deliveries"] = deliveries.stats()
+        stats["coalescer"] = coalescer.stats()
+        stats["response_cache"] = get_response_cache().stats()
+        stats["reconciler"] = reconciler.stats()
+        if sync is not None:
+            stats["shared"] = sync.stats()
+        return json.dumps(stats)
+
+    @app.route('/branch_protection/metrics', methods=['GET'])
+    def metrics():  # pylint: disable=unused-variable
+        """Metrics in the Prometheus text format"""
+        return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
     @app.route('/branch_protection/hello', methods=['GET'])
     def hello():  # pylint: disable=unused-variable
         """ Returns "Hello World!" to test if the service is alive.
@@ -488,5 +1180,5 @@ def create_app():
 if __name__ == "__main__":
     # logging.getLogger().setLevel(logging.INFO)
     app = create_app()
-    app.logger.setLevel(logging.INFO)
+    app.logger.setLevel(os.environ.get("LOGLEVEL", "INFO"))
     app.run(host='0.0.0.0', port=6000, threaded=True, debug=False)
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""Local stand-in for the Gitea endpoints the service calls, with configurable latency, errors and rate limit
+
+Usage : python -m benchmarks.fake_gitea [--port 3000] [--latency 0.01] [--error-rate 0.01] [--rate-limit 500]
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+MAX_PAGE_SIZE = 50
+_REPO_ROUTE = re.compile(r"^/api/v1/repos/([^/]+)/([^/]+)/(branches|branch_protections)(?:/(.+))?$")
+_ORG_ROUTE = re.compile(r"^/api/v1/orgs/([^/]+)/repos$")
+
+
+class FakeRepository:
+    """Branches and protections of one repository"""
+    def __init__(self, branches=(), archived=False):
+        self.lock = threading.Lock()
+        self.branches = list(branches)
+        self.protections = {}
+        self.archived = archived
+
+
+class FakeGitea:
+    """In-memory Gitea serving paginated listings with Link and X-Total-Count headers"""
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit=0, seed=42):
+        self.latency = latency
+        self.error_rate = error_rate
+        # requests per second allowed, 0 for no limit
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.repositories = {}
+        self.requests = 0
+        self.errors = 0
+        self.limited = 0
+        self.not_modified = 0
+        self.tokens = float(rate_limit)
+        self.refilled_at = time()
+        self.server = None
+
+    def add_repository(self, full_name, branches=(), archived=False):
+        repository = self.repositories[full_name] = FakeRepository(branches, archived)
+        return repository
+
+    def organization_repositories(self, organization):
+        prefix = organization + "/"
+        return [(name, self.repositories[name]) for name in sorted(self.repositories) if name.startswith(prefix)]
+
+    def admit(self):
+        """Count the request, then return None or the error status it should get"""
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit:
+                now = time()
+                self.tokens = min(float(self.rate_limit), self.tokens + (now - self.refilled_at) * self.rate_limit)
+                self.refilled_at = now
+                if self.tokens < 1:
+                    self.limited += 1
+                    return 429
+                self.tokens -= 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 500
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "rate_limited": self.limited,
+                    "not_modified": self.not_modified}
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve in a background thread, return the API url"""
+        fake = self
+
+        class Handler(FakeGiteaHandler):
+            gitea = fake
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-gitea", daemon=True).start()
+        return "http://{}:{}/api/v1/".format(host, self.server.server_port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class FakeGiteaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    gitea = None
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def refuse(self):
+        """Apply latency, errors and rate limit, True if the request was answered with an error"""
+        if self.gitea.latency:
+            sleep(self.gitea.latency)
+        status = self.gitea.admit()
+        if status is None:
+            return False
+        # the body must be read for the connection to be reused
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        headers = [("Retry-After", "1"), ("X-RateLimit-Remaining", "0"), ("X-RateLimit-Reset", "1")] \
+            if status == 429 else []
+        self.send_json(status, {"message": "fake error"}, headers)
+        return True
+
+    def paginate(self, items, url, query):
+        """Send a page of items with the headers Gitea sends, or 304 when If-None-Match holds its ETag"""
+        page_size = min(int(query.get("limit", query.get("per_page", ["30"]))[0]), MAX_PAGE_SIZE)
+        page = max(int(query.get("page", ["1"])[0]), 1)
+        last = max(1, -(-len(items) // page_size))
+        base = "http://{}{}".format(self.headers.get("Host"), url.path)
+        links = []
+        if page < last:
+            links.append('<{}?limit={}&page={}>; rel="next"'.format(base, page_size, page + 1))
+            links.append('<{}?limit={}&page={}>; rel="last"'.format(base, page_size, last))
+        if page > 1:
+            links.append('<{}?limit={}&page={}>; rel="first"'.format(base, page_size, 1))
+        headers = [("X-Total-Count", str(len(items)))]
+        if links:
+            headers.append(("Link", ", ".join(links)))
+        body = items[(page - 1) * page_size:page * page_size]
+        etag = '"{}"'.format(hashlib.sha1(json.dumps([body, headers]).encode()).hexdigest())
+        headers.append(("ETag", etag))
+        if self.headers.get("If-None-Match") == etag:
+            with self.gitea.lock:
+                self.gitea.not_modified += 1
+            self.send_response(304)
+            for key, value in headers:
+                self.send_header(key, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json(200, body, headers)
+
+    def repository(self):
+        url = urlsplit(self.path)
+        match = _REPO_ROUTE.match(url.path)
+        if match is None:
+            return url, None, None
+        repository = self.gitea.repositories.get(match.group(1) + "/" + match.group(2))
+        return url, match, repository
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.refuse():
+            return
+        url, match, repository = self.repository()
+        query = parse_qs(url.query)
+        if match is None:
+            organization = _ORG_ROUTE.match(url.path)
+            if organization is None:
+                return self.send_json(404, {"message": "not found"})
+            items = [{"full_name": name, "name": name.split("/", 1)[1], "archived": repository.archived,
+                      "empty": not repository.branches}
+                     for name, repository in self.gitea.organization_repositories(organization.group(1))]
+            return self.paginate(items, url, query)
+        if repository is None:
+            return self.send_json(404, {"message": "repository not found"})
+        with repository.lock:
+            if match.group(3) == "branches":
+                items = [{"name": name} for name in repository.branches]
+            else:
+                items = [repository.protections[name] for name in sorted(repository.protections)]
+        self.paginate(items, url, query)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.refuse():
+            return
+        url, match, repository = self.repository()
+        if repository is None or match.group(3) != "branch_protections":
+            return self.send_json(404, {"message": "not found"})
+        body = self.read_json()
+        with repository.lock:
+            if body.get("branch_name") in repository.protections:
+                return self.send_json(403, {"message": "Branch protection already exist"})
+            body["rule_name"] = body.get("branch_name")
+            repository.protections[body["branch_name"]] = body
+        self.send_json(201, body)
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        if self.refuse():
+            return
+        url, match, repository = self.repository()
+        if repository is None or match.group(3) != "branch_protections" or not match.group(4):
+            return self.send_json(404, {"message": "not found"})
+        name = unquote(match.group(4))
+        body = self.read_json()
+        with repository.lock:
+            if name not in repository.protections:
+                return self.send_json(404, {"message": "protection not found"})
+            repository.protections[name].update(body)
+            protection = dict(repository.protections[name])
+        self.send_json(200, protection)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Gitea API")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered 500")
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per second, 0 for no limit")
+    parser.add_argument("--repos", type=int, default=10, help="repositories generated in the org benchmark")
+    parser.add_argument("--branches", type=int, default=1000, help="branches per repository")
+    args = parser.parse_args()
+    # imported here : the generator is only needed when serving standalone
+    from benchmarks.generate import populate
+    gitea = FakeGitea(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    populate(gitea, "benchmark", args.repos, args.branches)
+    print("Serving {} on port {}".format(gitea.start("0.0.0.0", args.port), args.port))
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
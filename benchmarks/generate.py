@@ -0,0 +1,53 @@
+"""Synthetic organizations for the benchmarks : N repositories x M branches, and the matching ini file"""
+import os
+import random
+
+BRANCH_RULES = '[r"(.*/master)", r"(^release/.*)", "develop"]'
+SETTINGS = """enable_push : true
+enable_push_whitelist : true
+enable_merge_whitelist : true
+merge_whitelist_teams : ["Owners"]
+push_whitelist_teams : ["Owners"]
+block_on_rejected_reviews : true
+required_approvals: 1
+approvals_whitelist_teams : ["Owners"]
+dismiss_stale_approvals : true
+"""
+
+
+def repository_name(number):
+    return "repo-{:04d}".format(number)
+
+
+def branch_names(count, seed):
+    """About a fifth of the branches match the rules of BRANCH_RULES"""
+    rand = random.Random(seed)
+    kinds = ["feature", "bugfix", "user", "team"]
+    names = ["develop"]
+    for number in range(1, count):
+        roll = rand.random()
+        if roll < 0.1:
+            names.append("release/{}.{}".format(number // 10, number % 10))
+        elif roll < 0.2:
+            names.append("{}-{}/master".format(rand.choice(kinds), number))
+        else:
+            names.append("{}/{}-{}".format(rand.choice(kinds), number, rand.randint(0, 9999)))
+    return names
+
+
+def populate(gitea, organization, repositories, branches):
+    """Add the repositories of organization to a FakeGitea"""
+    for number in range(repositories):
+        gitea.add_repository(organization + "/" + repository_name(number), branch_names(branches, number))
+
+
+def write_config(directory, organization, repositories, glob=False):
+    """Write <organization>.ini with one section per repository, or a single [*] one, return its path"""
+    filename = os.path.join(directory, organization + ".ini")
+    with open(filename, "w", encoding="utf-8") as config:
+        if glob:
+            config.write("[*]\nbranches: {}\n{}\n".format(BRANCH_RULES, SETTINGS))
+            return filename
+        for number in range(repositories):
+            config.write("[{}]\nbranches: {}\n{}\n".format(repository_name(number), BRANCH_RULES, SETTINGS))
+    return filename
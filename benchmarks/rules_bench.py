@@ -0,0 +1,54 @@
+"""Micro-benchmark : precompiled BranchRules against the per-call ast.literal_eval + re.match path
+
+Usage : python -m benchmarks.rules_bench [branches] [repeat]
+"""
+import ast
+import random
+import re
+import sys
+from timeit import timeit
+
+from scripts.rules import BranchRules
+
+RULES = '["master", "develop", r"(.*/master)", r"(.*/release)", r"(^release\\w*)", r"(^r[0-9]+d[0-9]\\w*)"]'
+
+
+def legacy_is_branch_in_regex(repo_parameters, ref_branch):
+    """Copy of the former RepositoryHandler.is_branch_in_regex"""
+    regexed_branches = ast.literal_eval(repo_parameters["branches"])
+    for regex in regexed_branches:
+        if re.match(regex, ref_branch):
+            return True
+    return False
+
+
+def make_branches(count, seed=42):
+    """Synthetic branch names close to what a monorepo carries"""
+    rand = random.Random(seed)
+    prefixes = ["feature", "bugfix", "hotfix", "team", "user", "release", "r2d2"]
+    suffixes = ["master", "release", "wip", "test", "JIRA-{}"]
+    branches = []
+    for i in range(count):
+        suffix = rand.choice(suffixes).format(i)
+        branches.append("{}/{}-{}/{}".format(rand.choice(prefixes), rand.randint(0, 999), i, suffix))
+    return branches
+
+
+def main(count=20000, repeat=5):
+    repo_parameters = {"branches": RULES}
+    branches = make_branches(count)
+    rules = BranchRules.from_config(repo_parameters)
+    legacy = {b for b in branches if legacy_is_branch_in_regex(repo_parameters, b)}
+    assert legacy == rules.match_many(branches), "matcher disagrees with the legacy path"
+
+    legacy_time = timeit(lambda: [legacy_is_branch_in_regex(repo_parameters, b) for b in branches], number=repeat)
+    build_time = timeit(lambda: BranchRules.from_config(repo_parameters), number=repeat)
+    match_time = timeit(lambda: rules.match_many(branches), number=repeat)
+    print("{} branches, {} matching, {} runs".format(count, len(legacy), repeat))
+    print("legacy      : {:.4f}s per run".format(legacy_time / repeat))
+    print("match_many  : {:.4f}s per run (+{:.6f}s build)".format(match_time / repeat, build_time / repeat))
+    print("speedup     : x{:.1f}".format(legacy_time / match_time))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
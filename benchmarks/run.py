@@ -0,0 +1,208 @@
+"""Offline benchmark of the service against a local fake Gitea
+
+Every scenario runs in its own process, against the same fake server, in a generated working directory.
+
+Usage : python -m benchmarks.run [--repos 20] [--branches 2000] [--latency 0.005] [--error-rate 0.0]
+                                 [--rate-limit 0] [--events 500] [--drift 0.1] [--scenario push_list ...] [--glob]
+                                 [--json]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from time import perf_counter, sleep
+
+from benchmarks.fake_gitea import FakeGitea
+from benchmarks.generate import populate, write_config
+from scripts.dedup import drained
+
+ORGANIZATION = "benchmark"
+SCENARIOS = ("cold_startup", "warm_startup", "push_list", "force_push_list", "webhook_burst")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def summary(name, elapsed, operations, latencies, extra=None):
+    """Result of a scenario, latencies in milliseconds"""
+    result = {
+        "scenario": name,
+        "elapsed": round(elapsed, 3),
+        "operations": operations,
+        "throughput": round(operations / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        # kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    result.update(extra or {})
+    return result
+
+
+def timed_client():
+    """Install a shared client recording the latency of every Gitea call"""
+    from scripts import http_client
+    latencies = []
+
+    class TimedClient(http_client.GiteaClient):
+        def request(self, method, url, **kwargs):
+            started = perf_counter()
+            try:
+                return http_client.GiteaClient.request(self, method, url, **kwargs)
+            finally:
+                latencies.append(perf_counter() - started)
+    http_client._client = TimedClient()
+    return latencies
+
+
+def wait_ready(client):
+    while client.get("/branch_protection/ready").status_code != 200:
+        sleep(0.01)
+
+
+def wait_tasks(client):
+    while True:
+        stats = json.loads(client.get("/branch_protection/tasks").data)
+        if drained(stats["coalescer"]) and not stats["depth"] and not stats["running"]:
+            return stats
+        sleep(0.01)
+
+
+def run_scenario(name, events):
+    """Body of a worker process, the working directory is the generated one"""
+    latencies = timed_client()
+    from app import create_app
+    if name in ("cold_startup", "warm_startup"):
+        if name == "cold_startup":
+            for snapshot in glob("*_branches.jsonl"):
+                os.remove(snapshot)
+        started = perf_counter()
+        client = create_app().test_client()
+        first_request = perf_counter() - started
+        wait_ready(client)
+        elapsed = perf_counter() - started
+        repositories = json.loads(client.get("/branch_protection/ready").data)["built"]
+        return summary(name, elapsed, repositories, latencies,
+                       {"unit": "repos", "first_request_s": round(first_request, 3), "api_calls": len(latencies)})
+    client = create_app().test_client()
+    wait_ready(client)
+    del latencies[:]
+    if name in ("push_list", "force_push_list"):
+        started = perf_counter()
+        report = json.loads(client.get("/branch_protection/" + name).data)
+        elapsed = perf_counter() - started
+        calls = report["created"] + report["patched"] + report["failed"]
+        return summary(name, elapsed, calls, latencies, {"unit": "calls", "failed": report["failed"]})
+    # webhook_burst : a release script creating branches on every repository
+    repositories = sorted(json.loads(client.get("/branch_protection/list").data))
+    payloads = [{
+        "ref": "refs/heads/release/burst-{}".format(number),
+        "after": "{:040x}".format(number + 1),
+        "repository": {"full_name": full_name, "name": full_name.split("/")[1], "html_url": ""},
+    } for number in range(events) for full_name in [repositories[number % len(repositories)]]]
+    request_latencies = []
+
+    def post(number):
+        headers = {"X-Gitea-Event": "push", "X-Gitea-Delivery": "burst-{}".format(number)}
+        sent = perf_counter()
+        client.post("/branch_protection/webhook", json=payloads[number], headers=headers)
+        request_latencies.append(perf_counter() - sent)
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(post, range(events)))
+    accepted = perf_counter() - started
+    stats = wait_tasks(client)
+    elapsed = perf_counter() - started
+    return summary(name, elapsed, events, request_latencies, {
+        "unit": "events", "accepted_s": round(accepted, 3), "api_calls": len(latencies),
+        "api_p99_ms": round(percentile(latencies, 0.99) * 1000, 2), "protected": stats["completed"],
+    })
+
+
+def drift(gitea, share, seed=7):
+    """Change the settings of a share of the protections, for force_push_list to renew"""
+    rand = random.Random(seed)
+    changed = 0
+    for repository in gitea.repositories.values():
+        with repository.lock:
+            for protection in repository.protections.values():
+                if rand.random() < share:
+                    protection["required_approvals"] = 2
+                    changed += 1
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the service against a local fake Gitea")
+    parser.add_argument("--repos", type=int, default=20)
+    parser.add_argument("--branches", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added by the fake server")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per second, 0 for no limit")
+    parser.add_argument("--events", type=int, default=500, help="webhook events of the burst scenario")
+    parser.add_argument("--drift", type=float, default=0.1, help="share of protections changed before force_push_list")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="repeatable, all by default")
+    parser.add_argument("--glob", action="store_true", help="discover the repositories through a single [*] section")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--worker", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        print(json.dumps(run_scenario(args.worker, args.events)))
+        return
+
+    gitea = FakeGitea(latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    populate(gitea, ORGANIZATION, args.repos, args.branches)
+    api_url = gitea.start()
+    workdir = tempfile.mkdtemp(prefix="branch_protection_bench_")
+    write_config(workdir, ORGANIZATION, args.repos, glob=args.glob)
+    env = dict(os.environ, GITEA_API_URL=api_url, GITEA_TOKEN="benchmark", LOGLEVEL="WARNING",
+               PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+               BRANCH_RESYNC_INTERVAL="0", WEBHOOK_JOURNAL=os.path.join(workdir, "webhook.jsonl"))
+    results = []
+    try:
+        for name in args.scenario or SCENARIOS:
+            if name == "force_push_list":
+                drift(gitea, args.drift)
+                # the service learns the drift from a resync : start from the API rather than the snapshots
+                for snapshot in glob(os.path.join(workdir, "*_branches.jsonl")):
+                    os.remove(snapshot)
+            before = gitea.stats()
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.run", "--worker", name, "--events", str(args.events)],
+                cwd=workdir, env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            after = gitea.stats()
+            result["server"] = {key: after[key] - before[key] for key in after}
+            results.append(result)
+    finally:
+        gitea.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{} repos x {} branches, latency {}s, error rate {}, rate limit {}/s".format(
+        args.repos, args.branches, args.latency, args.error_rate, args.rate_limit or "none"))
+    print("{:<16} {:>9} {:>10} {:>16} {:>9} {:>9} {:>9} {:>9}".format(
+        "scenario", "elapsed", "ops", "throughput", "p50 ms", "p99 ms", "rss MB", "requests"))
+    for result in results:
+        print("{:<16} {:>8.2f}s {:>10} {:>10.1f} {:<5} {:>9} {:>9} {:>9} {:>9}".format(
+            result["scenario"], result["elapsed"], result["operations"], result["throughput"],
+            result["unit"] + "/s", result["p50_ms"], result["p99_ms"], result["peak_rss_mb"],
+            result["server"]["requests"]))
+
+
+if __name__ == "__main__":
+    main()
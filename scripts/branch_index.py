@@ -0,0 +1,150 @@
+"""Module keeping the branches of a repository in memory and on disk"""
+import ast
+import bisect
+import itertools
+import json
+import os
+import tempfile
+import threading
+from time import time
+
+SNAPSHOT_VERSION = 2
+# version 1 only stored names, version 2 adds an optional [name, data] line form
+READABLE_VERSIONS = (1, 2)
+SNAPSHOT_SUFFIX = ".jsonl"
+# shared by every index : a version is never given twice, even to a new index replacing another one
+_versions = itertools.count(1)
+
+
+class BranchIndex:
+    """Set of branch names, with a sorted view for prefix queries and optional data per branch"""
+    def __init__(self, branches=()):
+        self.lock = threading.Lock()
+        self.names = set(branches)
+        self.data = {}
+        self._sorted = None
+        self.saved_at = None
+        # changes on every update, for the listings to tell whether they changed
+        self.version = next(_versions)
+
+    def __contains__(self, branch):
+        return branch in self.names
+
+    def __iter__(self):
+        return iter(self.sorted())
+
+    def __len__(self):
+        return len(self.names)
+
+    def __bool__(self):
+        return bool(self.names)
+
+    def sorted(self):
+        """Sorted copy, rebuilt only after a change"""
+        view = self._sorted
+        if view is None:
+            with self.lock:
+                view = self._sorted = sorted(self.names)
+        return view
+
+    def add(self, branch, data=None):
+        with self.lock:
+            if branch not in self.names:
+                self.names.add(branch)
+                self._sorted = None
+                self.version = next(_versions)
+            if data is not None:
+                self.data[branch] = data
+
+    def update_data(self, items):
+        """Add (branch, data) couples"""
+        with self.lock:
+            for branch, data in items:
+                self.names.add(branch)
+                self.data[branch] = data
+            self._sorted = None
+            self.version = next(_versions)
+
+    def get(self, branch):
+        """Data stored for the branch, None if unknown"""
+        return self.data.get(branch)
+
+    def update(self, branches):
+        with self.lock:
+            self.names.update(branches)
+            self._sorted = None
+            self.version = next(_versions)
+
+    def discard(self, branch):
+        with self.lock:
+            if branch in self.names:
+                self.names.discard(branch)
+                self.data.pop(branch, None)
+                self._sorted = None
+                self.version = next(_versions)
+
+    def prefix(self, prefix, after=None, limit=None):
+        """Every branch starting with prefix, in order, only the ones sorting after `after` and at most limit"""
+        view = self.sorted()
+        start = bisect.bisect_left(view, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(view, after))
+        stop = len(view) if limit is None else min(len(view), start + limit)
+        if not prefix:
+            return view[start:stop]
+        end = start
+        while end < stop and view[end].startswith(prefix):
+            end += 1
+        return view[start:end]
+
+    def is_fresh(self, max_age):
+        """True if the snapshot this index came from is younger than max_age seconds (0 : never expires)"""
+        if self.saved_at is None:
+            return False
+        return not max_age or time() - self.saved_at < max_age
+
+    def save(self, filename):
+        """Atomically write a versioned JSON-lines snapshot : a header, then one name (or [name, data]) per line"""
+        view = self.sorted()
+        saved_at = time()
+        header = {"version": SNAPSHOT_VERSION, "saved_at": saved_at, "count": len(view)}
+        # a temporary file of its own : the reconciler and a push_list may save the same index at once
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                                 prefix=os.path.basename(filename) + ".", suffix=".tmp")
+        try:
+            with open(descriptor, "w", encoding="utf-8") as saving:
+                saving.write(json.dumps(header))
+                saving.write("\n")
+                data = self.data
+                saving.writelines(json.dumps([name, data[name]] if name in data else name) + "\n" for name in view)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.saved_at = saved_at
+
+    @classmethod
+    def load(cls, filename):
+        """Read a snapshot written by save, raise ValueError if it is not one"""
+        with open(filename, "r", encoding="utf-8") as reading:
+            header = json.loads(reading.readline() or "null")
+            if not isinstance(header, dict) or header.get("version") not in READABLE_VERSIONS:
+                raise ValueError("unsupported snapshot {}".format(filename))
+            # one json.loads over the whole body is much faster than one per line
+            lines = reading.read().split("\n")
+            entries = json.loads("[" + ",".join(line for line in lines if line) + "]")
+        index = cls(entry for entry in entries if isinstance(entry, str))
+        index.update_data(entry for entry in entries if isinstance(entry, list))
+        if len(index) != header["count"]:
+            raise ValueError("truncated snapshot {}".format(filename))
+        index.saved_at = header["saved_at"]
+        return index
+
+    @classmethod
+    def load_legacy(cls, filename):
+        """Read the former str(list) text files"""
+        with open(filename, "r", encoding="utf-8") as reading:
+            content = reading.read().strip()
+        index = cls(ast.literal_eval(content) if content else [])
+        index.saved_at = os.path.getmtime(filename)
+        return index
@@ -1,7 +1,14 @@
 """Module interacting with the config.ini file, for dynamically import repositories and branches"""
 import configparser
+import hashlib
 from pathlib import Path
 import os
+import threading
+import logging
+
+from scripts.metrics import cache_lookup
+
+log = logging.getLogger(__name__)
 
 # Example datas :
 # conf_var = "Pull_server"
@@ -12,6 +19,83 @@ import os
 #
 # config_write(conf_var, config_dictionnary)
 
+# config file path -> (mtime and size, sha256 of the content, parsed config)
+_parsed = {}
+_parsed_lock = threading.Lock()
+
+
+def load_config(config_file):
+    """Parse an ini file once, it is parsed again only when its mtime changed and its content too"""
+    stat = os.stat(config_file)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _parsed.get(config_file)
+    cache_lookup("config", cached is not None and cached[0] == stamp)
+    if cached is not None and cached[0] == stamp:
+        return cached[1], cached[2]
+    with _parsed_lock:
+        with open(config_file, "rb") as reading:
+            content = reading.read()
+        digest = hashlib.sha256(content).hexdigest()
+        cached = _parsed.get(config_file)
+        if cached is not None and cached[1] == digest:
+            # touched but not modified : keep the parsed config
+            _parsed[config_file] = (stamp, digest, cached[2])
+            return digest, cached[2]
+        config = configparser.ConfigParser(delimiters=':')
+        config.read_string(content.decode("utf-8"), source=config_file)
+        _parsed[config_file] = (stamp, digest, config)
+        return digest, config
+
+
+class ConfigWatcher(threading.Thread):
+    """Poll the mtime and size of the ini files, and hand the organizations whose file changed to a callback
+
+    callback(changed, removed) gets the names of the organizations, a new file counts as changed.
+    """
+    def __init__(self, base, callback, interval=2.0, pattern="**/*.ini"):
+        threading.Thread.__init__(self, daemon=True, name="config-watcher")
+        self.base = base
+        self.callback = callback
+        self.interval = interval
+        self.pattern = pattern
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # organization -> (mtime, size) of its file, the files present at startup are the baseline
+        self.stamps = self.scan()
+
+    def scan(self):
+        stamps = {}
+        for file in Path(self.base).glob(self.pattern):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            stamps[file.stem] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def poll(self):
+        """Organizations whose file changed or appeared, and the ones whose file disappeared, since the last poll"""
+        with self.lock:
+            stamps = self.scan()
+            changed = sorted(org for org, stamp in stamps.items() if self.stamps.get(org) != stamp)
+            removed = sorted(set(self.stamps) - set(stamps))
+            self.stamps = stamps
+        return changed, removed
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            changed, removed = self.poll()
+            if not changed and not removed:
+                continue
+            log.info("Config changed : %s, removed : %s", changed, removed)
+            try:
+                self.callback(changed, removed)
+            except Exception as e:
+                log.error("Cannot reload %s : %s", changed + removed, e)
+
+    def stop(self):
+        self.stopped.set()
+
 
 class ConfigReader:
     """Class to check the config files"""
@@ -22,24 +106,25 @@ class ConfigReader:
         self.config_file = None
         self.find_config(self.organization)
         self.sections = None
+        self.digest = None
 
     def find_config(self, config_org):
         """Find every config file in the present directory"""
         try:
             assert os.path.isfile(config_org + ".ini")
         except AssertionError as e:
-            print("no config file for {}, \n {}".format(config_org, e))
+            log.error("no config file for %s, \n %s", config_org, e)
             raise FileNotFoundError
         else:
             self.config_file = config_org + ".ini"
 
     def config_read(self):
         """Retrieve parameters within files"""
-        self.config.read(self.config_file)
+        self.digest, self.config = load_config(self.config_file)
         self.sections = self.config.sections()
 
     def config_get(self, section):
         """check if section is in config file"""
-        self.config.read(self.config_file)
+        self.digest, self.config = load_config(self.config_file)
         branches = self.config[section]
         return branches
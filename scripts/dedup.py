@@ -0,0 +1,126 @@
+"""Module dropping the retried webhook deliveries and merging the events of a busy branch"""
+import collections
+import threading
+from time import time
+import logging
+
+from scripts.metrics import cache_lookup
+
+log = logging.getLogger(__name__)
+
+
+class DeliveryCache:
+    """Bounded LRU of the delivery ids seen during the last ttl seconds"""
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.seen_at = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, delivery):
+        """True if delivery was already received, otherwise remember it. Events without id are never duplicates"""
+        if not delivery:
+            return False
+        now = time()
+        with self.lock:
+            # expired ids are at the front, the oldest first
+            while self.seen_at and next(iter(self.seen_at.values())) < now - self.ttl:
+                self.seen_at.popitem(last=False)
+            if delivery in self.seen_at:
+                self.seen_at.move_to_end(delivery)
+                self.hits += 1
+                cache_lookup("delivery", True)
+                return True
+            self.seen_at[delivery] = now
+            if len(self.seen_at) > self.max_size:
+                self.seen_at.popitem(last=False)
+            self.misses += 1
+            cache_lookup("delivery", False)
+            return False
+
+    def forget(self, delivery):
+        """Drop a delivery which was not accepted after all, so that the retry of Gitea is"""
+        if delivery:
+            with self.lock:
+                self.seen_at.pop(delivery, None)
+
+    def stats(self):
+        return {"size": len(self.seen_at), "deduplicated": self.hits, "accepted": self.misses}
+
+
+class Coalescer:
+    """Hold the events of a key for window seconds, only the last one received is run
+
+    A release script creating hundreds of branches, or back to back pushes on one branch,
+    end up as one action per branch.
+    """
+    def __init__(self, window=0.5, max_pending=10000):
+        self.window = window
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        # key -> (deadline, action), in deadline order since the window is fixed
+        self.pending = collections.OrderedDict()
+        self.received = 0
+        self.coalesced = 0
+        self.fired = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, name="coalescer", daemon=True)
+        self.thread.start()
+
+    def submit(self, key, action):
+        """Schedule action for key, replacing the one waiting. False when too many keys are waiting"""
+        with self.condition:
+            if key in self.pending:
+                self.received += 1
+                deadline = self.pending[key][0]
+                self.pending[key] = (deadline, action)
+                self.coalesced += 1
+                return True
+            if len(self.pending) >= self.max_pending:
+                return False
+            self.received += 1
+            self.pending[key] = (time() + self.window, action)
+            self.condition.notify()
+            return True
+
+    def due(self):
+        """Wait for the next deadline, then pop every due action"""
+        with self.condition:
+            while True:
+                now = time()
+                if self.pending:
+                    deadline = next(iter(self.pending.values()))[0]
+                    if deadline <= now:
+                        break
+                    self.condition.wait(deadline - now)
+                else:
+                    self.condition.wait()
+            actions = []
+            while self.pending and next(iter(self.pending.values()))[0] <= now:
+                actions.append(self.pending.popitem(last=False)[1][1])
+            return actions
+
+    def run(self):
+        while True:
+            for action in self.due():
+                try:
+                    action()
+                    self.fired += 1
+                except Exception as e:
+                    self.failed += 1
+                    log.error("Coalesced event failed : %s", e)
+
+    def stats(self):
+        with self.condition:
+            return {"waiting": len(self.pending), "received": self.received, "coalesced": self.coalesced,
+                    "fired": self.fired, "failed": self.failed}
+
+
+def drained(stats):
+    """True once every event accepted by a Coalescer (its stats) was merged or run
+
+    An action popped by due() is neither waiting nor fired until it returns.
+    """
+    return stats["received"] == stats["coalesced"] + stats["fired"] + stats["failed"]
@@ -0,0 +1,88 @@
+"""Module finding the repositories of an organization, for the glob sections ([*], [service-*]...) of its ini file"""
+import fnmatch
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts.http_client import last_page
+from scripts.response_cache import get_response_cache
+
+log = logging.getLogger(__name__)
+
+# Gitea caps the repositories listed per page to 50 by default
+PAGE_SIZE = 50
+
+
+def is_pattern(section):
+    """True for a section applied to every repository whose name it matches"""
+    return any(char in section for char in "*?[")
+
+
+def section_for(sections, repository):
+    """Section describing repository : its own one, otherwise the first glob section matching its name"""
+    if repository in sections and not is_pattern(repository):
+        return repository
+    for section in sections:
+        if is_pattern(section) and fnmatch.fnmatchcase(repository, section):
+            return section
+    return None
+
+
+class DiscoveryError(Exception):
+    """The organization listing could not be read"""
+
+
+class OrgDiscovery:
+    """Paginated listing of the repositories of an organization, every page revalidated by the response cache
+
+    When nothing changed a rescan is one 304 per page, without any body.
+    """
+    def __init__(self, organization, url, headers, verify=True, concurrency=8):
+        self.organization = organization
+        self.url = url
+        self.headers = headers
+        self.verify = verify
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.repositories = None
+        self.skipped = 0
+
+    def fetch_page(self, page):
+        """Repositories of one page, and the pages the listing has"""
+        r = get_response_cache().get(self.url, params={"limit": PAGE_SIZE, "page": page}, headers=self.headers,
+                                     verify=self.verify, repo=self.organization)
+        if r.status_code != 200:
+            raise DiscoveryError("Cannot list {} page {} : {} {}".format(self.url, page, r.status_code, r.text))
+        items = r.json()
+        return items, last_page(r, len(items)) if page == 1 else None
+
+    def scan(self):
+        """Names of the active repositories, archived and empty ones are skipped without any call
+
+        The last known list is returned when the API cannot be read, so handlers are never dropped on an error.
+        """
+        with self.lock:
+            try:
+                items, pages = self.fetch_page(1)
+                listing = list(items)
+                if pages is None:
+                    # no count available : read the pages one after the other until a short one
+                    page, page_size = 1, len(items)
+                    while items and len(items) >= page_size:
+                        page += 1
+                        items, _ = self.fetch_page(page)
+                        listing.extend(items)
+                elif pages > 1:
+                    with ThreadPoolExecutor(max_workers=min(self.concurrency, pages - 1)) as pool:
+                        for items, _ in pool.map(self.fetch_page, range(2, pages + 1)):
+                            listing.extend(items)
+            except Exception as e:
+                log.error("Cannot discover the repositories of %s : %s", self.organization, e)
+                return list(self.repositories or [])
+            repositories = [item["name"] for item in listing if not item.get("archived") and not item.get("empty")]
+            self.skipped = len(listing) - len(repositories)
+            if repositories != self.repositories:
+                log.info("Discovered %s repositories in %s, %s archived or empty skipped",
+                         len(repositories), self.organization, self.skipped)
+            self.repositories = repositories
+            return list(repositories)
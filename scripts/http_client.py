@@ -0,0 +1,140 @@
+"""Module sharing one pooled HTTP client between every repository handler"""
+import os
+import random
+import threading
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scripts.metrics import REGISTRY
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Methods sent again after a read timeout, the others may already have been applied
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+API_CALLS = REGISTRY.counter("gitea_api_calls_total", "Calls sent to Gitea", ("repo", "method", "status"))
+API_SECONDS = REGISTRY.histogram("gitea_api_call_seconds", "Latency of the calls sent to Gitea", ("repo", "method"))
+API_RETRIES = REGISTRY.counter("gitea_api_retries_total", "Calls sent again after an error", ("repo", "method"))
+
+
+class GiteaClient:
+    """Thread-safe requests.Session with keep-alive, per-host limits, backoff and rate-limit awareness"""
+    def __init__(self, pool_size=32, per_host=16, retries=4, backoff=0.2, max_backoff=30.0, timeout=30):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.host_slots = {}
+        # epoch until which the server asked us to stay quiet
+        self.paused_until = 0.0
+
+    def slots(self, host):
+        """Semaphore bounding the concurrent calls to one host"""
+        with self.lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = self.host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return slot
+
+    def delay(self, attempt, response=None):
+        """Exponential backoff with full jitter, Retry-After wins when the server sends it"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def observe_rate_limit(self, response):
+        """Pause every caller when Gitea reports an exhausted rate limit"""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining == "0" and reset and reset.isdigit():
+            reset_at = float(reset)
+            # some servers send a delay in seconds instead of an epoch
+            if reset_at < 10 ** 9:
+                reset_at += time()
+            with self.lock:
+                self.paused_until = max(self.paused_until, min(reset_at, time() + self.max_backoff))
+
+    def wait_rate_limit(self):
+        wait = self.paused_until - time()
+        if wait > 0:
+            sleep(wait)
+
+    def request(self, method, url, repo="", **kwargs):
+        """Send a request, retrying connection errors, 429 and 5xx. repo labels the metrics
+
+        A read timeout is only retried for the idempotent methods : a POST may have been applied by the server.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        slot = self.slots(urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            self.wait_rate_limit()
+            started = time()
+            try:
+                with slot:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                API_CALLS.inc(repo, method, "error")
+                # a connect timeout is a ConnectionError too : the request was never sent
+                sent = not isinstance(e, requests.ConnectionError)
+                if attempt >= self.retries or (sent and method.upper() not in IDEMPOTENT_METHODS):
+                    raise
+                sleep(self.delay(attempt))
+            else:
+                API_CALLS.inc(repo, method, str(response.status_code))
+                API_SECONDS.observe(time() - started, repo, method)
+                self.observe_rate_limit(response)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                sleep(self.delay(attempt, response))
+            API_RETRIES.inc(repo, method)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+
+def last_page(response, page_size):
+    """Number of pages announced by the first page of a listing, None if the server does not tell"""
+    if "next" not in response.links:
+        return 1
+    if "last" in response.links:
+        page = parse_qs(urlsplit(response.links["last"]["url"]).query).get("page")
+        if page and page[0].isdigit():
+            return int(page[0])
+    total = response.headers.get("X-Total-Count")
+    if total and total.isdigit() and page_size:
+        return -(-int(total) // page_size)
+    return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process wide client, sized by GITEA_POOL_SIZE and GITEA_HOST_CONCURRENCY"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GiteaClient(
+                    pool_size=int(os.environ.get("GITEA_POOL_SIZE", 32)),
+                    per_host=int(os.environ.get("GITEA_HOST_CONCURRENCY", 16)),
+                )
+    return _client
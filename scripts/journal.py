@@ -0,0 +1,194 @@
+"""Module journaling the webhook events, and replaying them
+
+Usage : python -m scripts.journal replay webhook.jsonl [--url http://yourURL:yourport/branch_protection/webhook]
+"""
+import argparse
+import gzip
+import json
+import os
+import queue
+import threading
+from time import sleep, time
+
+from scripts.dedup import drained
+
+_STOP = object()
+
+
+class EventJournal:
+    """Append-only JSON-lines journal written by a background thread
+
+    record() never touches the disk : events are queued, then written and flushed in batches.
+    The file is rotated past max_bytes, keeping the backups last files, gzipped if compress is set.
+    """
+    def __init__(self, filename, max_bytes=50 * 1024 * 1024, backups=5, compress=True,
+                 flush_interval=1.0, batch_size=512, queue_size=10000):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name="journal", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def compact(headers, payload):
+        """The fields needed to understand, and replay, a webhook event"""
+        payload = payload if isinstance(payload, dict) else {}
+        repository = payload.get("repository") or {}
+        return {
+            "delivery": headers.get("X-Gitea-Delivery"),
+            "event": headers.get("X-Gitea-Event"),
+            "repo": repository.get("full_name"),
+            "ref": payload.get("ref"),
+            "ref_type": payload.get("ref_type"),
+            "before": payload.get("before"),
+            "after": payload.get("after"),
+            "timestamp": round(time(), 3),
+        }
+
+    def record(self, headers, payload):
+        """Queue an event, dropped (and counted) if the writer cannot keep up"""
+        try:
+            self.queue.put_nowait(self.compact(headers, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        journal = open(self.filename, "a", encoding="utf-8")
+        try:
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                batch = [record]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = _STOP in batch
+                journal.writelines(json.dumps(item, separators=(",", ":")) + "\n"
+                                   for item in batch if item is not _STOP)
+                journal.flush()
+                self.written += len(batch) - stop
+                if journal.tell() >= self.max_bytes:
+                    journal.close()
+                    self.rotate()
+                    journal = open(self.filename, "a", encoding="utf-8")
+                if stop:
+                    return
+        finally:
+            journal.close()
+
+    def backup_name(self, number):
+        return "{}.{}{}".format(self.filename, number, ".gz" if self.compress else "")
+
+    def rotate(self):
+        """Shift the backups by one, the current file becoming the first one"""
+        oldest = self.backup_name(self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.backup_name(number)):
+                os.replace(self.backup_name(number), self.backup_name(number + 1))
+        if not self.backups:
+            os.remove(self.filename)
+        elif self.compress:
+            with open(self.filename, "rb") as source, gzip.open(self.backup_name(1), "wb") as target:
+                target.writelines(source)
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, self.backup_name(1))
+
+    def close(self):
+        """Write what is queued, then stop the writer"""
+        self.queue.put(_STOP)
+        self.thread.join()
+
+
+def read_journal(filename):
+    """Yield the records of a journal file, gzipped or not"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8") as reading:
+        for line in reading:
+            if line.strip():
+                yield json.loads(line)
+
+
+def to_request(record, keep_delivery=False):
+    """Rebuild the webhook payload and headers of a journal record
+
+    The delivery id is left out unless keep_delivery : the service already saw it and would drop the event.
+    """
+    full_name = record.get("repo") or ""
+    payload = {
+        "ref": record.get("ref"),
+        "repository": {"full_name": full_name, "name": full_name.split("/")[-1], "html_url": ""},
+    }
+    for key in ("ref_type", "before", "after"):
+        if record.get(key) is not None:
+            payload[key] = record[key]
+    headers = {"X-Gitea-Event": record.get("event") or "push"}
+    if keep_delivery and record.get("delivery"):
+        headers["X-Gitea-Delivery"] = record["delivery"]
+    return payload, headers
+
+
+def replay(filename, post, keep_delivery=False):
+    """Feed every record of a journal to post(payload, headers), return how many were sent"""
+    sent = 0
+    for record in read_journal(filename):
+        payload, headers = to_request(record, keep_delivery)
+        post(payload, headers)
+        sent += 1
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a webhook journal")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replaying = subparsers.add_parser("replay", help="send the journal events through the webhook handling")
+    replaying.add_argument("journal", help="journal file, gzipped or not")
+    replaying.add_argument("--url", help="webhook url of a running service, the events are handled in process otherwise")
+    replaying.add_argument("--keep-delivery", action="store_true",
+                           help="send the recorded delivery ids, the events already received are dropped as retries")
+    args = parser.parse_args()
+    if args.url:
+        # imported here : only the remote replay needs it
+        from scripts.http_client import get_client
+        client = get_client()
+
+        def post(payload, headers):
+            client.post(args.url, json=payload, headers=headers)
+    else:
+        # the replayed events must not be appended to the journal being read
+        os.environ["WEBHOOK_JOURNAL"] = args.journal + ".replayed"
+        from app import create_app
+        test_client = create_app().test_client()
+
+        def post(payload, headers):
+            test_client.post("/branch_protection/webhook", json=payload, headers=headers)
+    started = time()
+    sent = replay(args.journal, post, args.keep_delivery)
+    if not args.url:
+        # let the deferred events and the queued protections finish
+        while test_client.get("/branch_protection/ready").status_code != 200:
+            sleep(0.1)
+        while True:
+            stats = json.loads(test_client.get("/branch_protection/tasks").data)
+            # the events still in the coalescing window reach the scheduler afterwards
+            if drained(stats["coalescer"]) and not stats["depth"] and not stats["running"]:
+                break
+            sleep(0.1)
+    elapsed = time() - started
+    print("{} events replayed in {:.2f}s ({:.1f}/s)".format(sent, elapsed, sent / elapsed if elapsed else 0.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Module streaming the protected branches of the handlers, filtered and paginated"""
+import base64
+import hashlib
+import json
+
+# Branches serialized at once while streaming a repository
+CHUNK_SIZE = 1000
+
+
+def encode_cursor(identity, branch):
+    """Opaque cursor : the listing goes on after branch of repository identity"""
+    return base64.urlsafe_b64encode(json.dumps([identity, branch]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(identity, branch) of a cursor, raise ValueError if it was not made by encode_cursor"""
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor {!r}".format(cursor)) from e
+    if not isinstance(decoded, list) or len(decoded) != 2 or not all(isinstance(part, str) for part in decoded):
+        raise ValueError("invalid cursor {!r}".format(cursor))
+    return decoded[0], decoded[1]
+
+
+def select(handlers, organization=None, repository=None):
+    """Handlers of an organization and / or a repository (name or org/name), in identity order"""
+    selected = [handler for handler in handlers
+                if (not organization or handler.organization == organization)
+                and (not repository or repository in (handler.repository, handler.identity))]
+    return sorted(selected, key=lambda handler: handler.identity)
+
+
+def etag(handlers, query, extra=None):
+    """Validator of a listing (unquoted), computed from the versions of the indexes without serializing them"""
+    digest = hashlib.sha1(query)
+    for handler in handlers:
+        digest.update("{}\0{}\0".format(handler.identity, handler.protected_branches.version).encode())
+    if extra is not None:
+        digest.update(json.dumps(extra, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def page(handlers, prefix="", cursor=None, limit=None):
+    """[(handler, branches)] of one page and the cursor of the next one, None on the last page
+
+    limit counts the branches, a repository may be split over two pages.
+    """
+    pages = []
+    count = 0
+    for handler in handlers:
+        after = None
+        if cursor is not None:
+            if handler.identity < cursor[0]:
+                continue
+            if handler.identity == cursor[0]:
+                after = cursor[1]
+        # one more branch than needed tells whether the listing goes on
+        wanted = None if limit is None else limit - count + 1
+        branches = handler.protected_branches.prefix(prefix, after, wanted)
+        if limit is not None and count + len(branches) > limit:
+            kept = limit - count
+            if kept:
+                pages.append((handler, branches[:kept]))
+                return pages, (handler.identity, branches[kept - 1])
+            return pages, (handler.identity, after or "")
+        pages.append((handler, branches))
+        count += len(branches)
+    return pages, None
+
+
+def stream(pages, statuses=None):
+    """Generate the JSON object of a page piece by piece : {"org/repo": [branches...], ...}
+
+    With statuses (identity -> dict), every repository is an object carrying its status and its protected_branches.
+    """
+    yield "{"
+    for number, (handler, branches) in enumerate(pages):
+        yield (", " if number else "") + json.dumps(handler.identity) + ": "
+        if statuses is not None:
+            status = json.dumps(statuses[handler.identity])
+            yield status[:-1] + (", " if status != "{}" else "") + '"protected_branches": '
+        yield "["
+        for start in range(0, len(branches), CHUNK_SIZE):
+            yield (", " if start else "") + json.dumps(branches[start:start + CHUNK_SIZE])[1:-1]
+        yield "]}" if statuses is not None else "]"
+    yield "}"
@@ -0,0 +1,142 @@
+"""Module collecting the service metrics, rendered in the Prometheus text format"""
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Monotonic counter, one value per label set"""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _labels(self.label_names, labels), value
+
+
+class Gauge(Counter):
+    """Value read when rendering, from a callback, or set by hand"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        Counter.__init__(self, name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.callback is not None:
+            # the callback returns a value, or a {labels: value} mapping
+            value = self.callback()
+            if isinstance(value, dict):
+                for labels, item in sorted(value.items()):
+                    yield self.name, _labels(self.label_names, labels), item
+            else:
+                yield self.name, "", value
+            return
+        for sample in Counter.samples(self):
+            yield sample
+
+
+class Histogram:
+    """Cumulative histogram of observations, one per label set"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels -> [count per bucket (+Inf last), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(state[0]), state[1]) for labels, state in self.values.items()}
+        names = self.label_names + ("le",)
+        for labels, (counts, total) in sorted(values.items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulated += count
+                yield self.name + "_bucket", _labels(names, labels + (bound,)), cumulated
+            yield self.name + "_sum", _labels(self.label_names, labels), total
+            yield self.name + "_count", _labels(self.label_names, labels), cumulated
+
+
+class Registry:
+    """Named metrics of the process"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        """Add a metric, or return the one already registered under its name"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        gauge = self.register(Gauge(name, documentation, labels))
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CACHE_REQUESTS = REGISTRY.counter(
+    "branch_protection_cache_requests_total", "Lookups of the internal caches", ("cache", "result"))
+
+
+def cache_lookup(cache, hit):
+    """Count a hit or a miss of an internal cache"""
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
@@ -0,0 +1,108 @@
+"""Module building the protection wanted by the ini files, and comparing it to the one stored by Gitea"""
+import ast
+import json
+import threading
+
+from scripts.metrics import cache_lookup
+
+# Option name patterns and the type Gitea expects for them
+_LIST_SUFFIXES = ("_teams", "_usernames", "_contexts")
+_BOOL_PREFIXES = ("enable_", "block_", "dismiss_", "require_")
+_INT_OPTIONS = ("required_approvals",)
+
+
+class ProtectionPayload:
+    """Typed and validated settings of a repository section, serialized once
+
+    Only the branch name changes from a call to another, it is spliced in front of the cached bytes.
+    """
+    def __init__(self, repo_parameters):
+        self.settings = self.parse(repo_parameters)
+        self.validate(self.settings)
+        self.patch_body = json.dumps(self.settings).encode()
+
+    @staticmethod
+    def parse(repo_parameters):
+        """Evaluate the ini values, "true" and "false" being JSON booleans"""
+        action_dict = {}
+        for k, v in repo_parameters.items():
+            if k != "branches":
+                try:
+                    action_dict[k] = ast.literal_eval(v)
+                except (ValueError, SyntaxError):
+                    # ensure Json boolean
+                    if v == "true":
+                        action_dict[k] = True
+                    elif v == "false":
+                        action_dict[k] = False
+                    else:
+                        action_dict[k] = v
+        return action_dict
+
+    @staticmethod
+    def validate(settings):
+        """Raise ValueError on an option whose value cannot be what Gitea expects"""
+        for key, value in settings.items():
+            if key.endswith(_LIST_SUFFIXES):
+                if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                    raise ValueError("{} must be a list of names, got {!r}".format(key, value))
+            elif key in _INT_OPTIONS:
+                if isinstance(value, bool) or not isinstance(value, int):
+                    raise ValueError("{} must be a number, got {!r}".format(key, value))
+            elif key.startswith(_BOOL_PREFIXES):
+                if not isinstance(value, bool):
+                    raise ValueError("{} must be true or false, got {!r}".format(key, value))
+
+    def post_body(self, branch):
+        """JSON body creating the protection of branch"""
+        name = b'{"branch_name": ' + json.dumps(branch).encode()
+        if not self.settings:
+            return name + b"}"
+        return name + b", " + self.patch_body[1:]
+
+
+_payloads = {}
+_payloads_lock = threading.Lock()
+
+
+def payload_for(reader, section):
+    """Cached ProtectionPayload of a section, rebuilt only when the content of the ini file changed"""
+    parameters = reader.config_get(section)
+    key = (reader.config_file, section)
+    cached = _payloads.get(key)
+    cache_lookup("payload", cached is not None and cached[0] == reader.digest)
+    if cached is not None and cached[0] == reader.digest:
+        return cached[1]
+    payload = ProtectionPayload(parameters)
+    with _payloads_lock:
+        _payloads[key] = (reader.digest, payload)
+    return payload
+
+
+def normalize(value):
+    """Comparable form of a protection value : lists are unordered, an empty list equals null"""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return sorted(str(item) for item in value) or None
+    if isinstance(value, str):
+        lowered = value.lower()
+        if lowered in ("true", "false"):
+            return lowered == "true"
+    return value
+
+
+def diff_settings(wanted, current):
+    """Keys of wanted whose value differs on the server, as {key: {"current": ..., "wanted": ...}}
+
+    Only the keys sent by protect_branch are compared, the server may return more fields.
+    A missing protection (current is None) differs on every key.
+    """
+    current = current or {}
+    diff = {}
+    for key, value in wanted.items():
+        if key == "branch_name":
+            continue
+        if key not in current or normalize(current[key]) != normalize(value):
+            diff[key] = {"current": current.get(key), "wanted": value}
+    return diff
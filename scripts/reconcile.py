@@ -0,0 +1,233 @@
+"""Module reconciling the protections of every repository against the rules of the ini files
+
+Usage : python -m scripts.reconcile [--force] [--dry-run] [--concurrency N]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", 32))
+
+
+class ReconcileEngine:
+    """Diff the wanted protections against the known ones, then send only the needed calls
+
+    Every call runs on one event loop, a single semaphore caps the calls in flight over every repository.
+    The calls go through the shared pooled client, on an executor sized like the semaphore.
+    """
+    def __init__(self, handlers, force=False, concurrency=CONCURRENCY):
+        self.handlers = list(handlers)
+        self.force = force
+        self.concurrency = concurrency
+
+    def plan(self):
+        """List the (handler, branch) couples to protect : missing ones, and existing ones differing when forcing"""
+        actions = []
+        for handler in self.handlers:
+            for branch in sorted(handler.branches_in_regex()):
+                if handler.needs_protection(branch, force=self.force):
+                    actions.append((handler, branch))
+        return actions
+
+    def dry_run(self):
+        """The calls run would send, with the settings they would change, without sending them"""
+        diff = {}
+        for handler, branch in self.plan():
+            action = "patch" if handler.is_branch_protected(branch) else "create"
+            diff.setdefault(handler.identity, {})[branch] = {"action": action, "diff": handler.protection_diff(branch)}
+        return diff
+
+    async def protect(self, loop, executor, semaphore, handler, branch, report):
+        patch = handler.is_branch_protected(branch)
+        async with semaphore:
+            try:
+                await loop.run_in_executor(executor, handler.protect_branch, branch)
+            except Exception as e:
+                report["failed"] += 1
+                report["errors"].append({"repository": handler.identity, "branch": branch, "error": str(e)})
+                return
+        report["patched" if patch else "created"] += 1
+
+    async def run_async(self, actions):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        report = {"planned": len(actions), "created": 0, "patched": 0, "failed": 0, "errors": []}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            await asyncio.gather(*[self.protect(loop, executor, semaphore, handler, branch, report)
+                                   for handler, branch in actions])
+        return report
+
+    def run(self, actions=None):
+        """Reconcile every handler, or only the planned actions given, return a report with the throughput"""
+        started = time()
+        if actions is None:
+            actions = self.plan()
+        report = asyncio.run(self.run_async(actions))
+        # persist the new protections now, the process may not live until the next flush
+        for handler in self.handlers:
+            handler.flush()
+        elapsed = time() - started
+        calls = report["created"] + report["patched"] + report["failed"]
+        report["repositories"] = len(self.handlers)
+        report["elapsed"] = round(elapsed, 3)
+        report["calls_per_second"] = round(calls / elapsed, 2) if elapsed else 0.0
+        return report
+
+
+class ApiBudget:
+    """Token bucket of the Gitea calls the background work may send each minute, 0 for no limit"""
+    def __init__(self, per_minute=600):
+        self.per_minute = per_minute
+        self.lock = threading.Lock()
+        self.tokens = float(per_minute)
+        self.refilled_at = time()
+        self.spent = 0
+
+    def refill(self):
+        """Called with the lock held"""
+        now = time()
+        self.tokens = min(float(self.per_minute), self.tokens + (now - self.refilled_at) * self.per_minute / 60.0)
+        self.refilled_at = now
+
+    def take(self, calls):
+        """Spend calls if the budget allows it, otherwise return the seconds to wait until it does"""
+        if not self.per_minute:
+            self.spent += calls
+            return 0.0
+        with self.lock:
+            self.refill()
+            # more calls than a whole minute : wait for a full bucket, then go into debt
+            needed = min(calls, self.per_minute)
+            if self.tokens < needed:
+                return (needed - self.tokens) * 60.0 / self.per_minute
+            self.tokens -= calls
+            self.spent += calls
+            return 0.0
+
+    def spend(self, calls):
+        """Spend calls already decided, the bucket may go into debt"""
+        with self.lock:
+            if self.per_minute:
+                self.refill()
+                self.tokens -= calls
+            self.spent += calls
+
+    def stats(self):
+        with self.lock:
+            if self.per_minute:
+                self.refill()
+            return {"per_minute": self.per_minute, "available": round(self.tokens, 1), "spent": self.spent}
+
+
+class AdaptiveSchedule:
+    """Reconcile interval of every repository, shorter as its webhook rate grows
+
+    The rate is an exponentially decaying count of the events (time_constant seconds), a repository is
+    reconciled about every events_per_reconcile events, within [min_interval, max_interval].
+    Every interval is jittered, and the first ones are spread over a whole interval, so the repositories
+    never come due all at once.
+    """
+    def __init__(self, min_interval=300, max_interval=3600, events_per_reconcile=20, time_constant=3600,
+                 jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.events_per_reconcile = events_per_reconcile
+        self.time_constant = time_constant
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        # identity -> [decayed event count, updated at, interval start, jitter factor, last reconciled]
+        self.repositories = {}
+
+    def entry(self, identity, now):
+        """Called with the lock held"""
+        entry = self.repositories.get(identity)
+        if entry is None:
+            entry = self.repositories[identity] = [0.0, now, now - random.uniform(0, self.max_interval), 1.0, None]
+        return entry
+
+    def decayed(self, entry, now):
+        return entry[0] * math.exp(-(now - entry[1]) / self.time_constant)
+
+    def observe(self, identity):
+        """Count a webhook event of identity"""
+        now = time()
+        with self.lock:
+            entry = self.entry(identity, now)
+            entry[0] = self.decayed(entry, now) + 1
+            entry[1] = now
+
+    def rate(self, entry, now):
+        """Events per second"""
+        return self.decayed(entry, now) / self.time_constant
+
+    def interval(self, entry, now):
+        rate = self.rate(entry, now)
+        if not rate:
+            return self.max_interval
+        return max(self.min_interval, min(self.max_interval, self.events_per_reconcile / rate))
+
+    def track(self, identities):
+        """Follow the given repositories only"""
+        now = time()
+        with self.lock:
+            for identity in identities:
+                self.entry(identity, now)
+            for identity in set(self.repositories) - set(identities):
+                del self.repositories[identity]
+
+    def due(self):
+        """Repositories to reconcile now, the most overdue first"""
+        now = time()
+        with self.lock:
+            overdue = []
+            for identity, entry in self.repositories.items():
+                late = (now - entry[2]) / (self.interval(entry, now) * entry[3])
+                if late >= 1:
+                    overdue.append((late, identity))
+        return [identity for _, identity in sorted(overdue, reverse=True)]
+
+    def done(self, identity):
+        """Record a reconcile, the next one comes after a new jittered interval"""
+        now = time()
+        with self.lock:
+            entry = self.entry(identity, now)
+            entry[2] = entry[4] = now
+            entry[3] = random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def status(self, identity):
+        """Last and next reconcile (epoch), interval (seconds) and webhook rate (events per hour) of identity"""
+        now = time()
+        with self.lock:
+            entry = self.repositories.get(identity)
+            if entry is None:
+                return {"last_reconciled": None, "next_reconcile": None, "interval": None, "webhooks_per_hour": 0.0}
+            interval = self.interval(entry, now) * entry[3]
+            return {"last_reconciled": entry[4], "next_reconcile": round(entry[2] + interval, 3),
+                    "interval": round(interval, 1), "webhooks_per_hour": round(self.rate(entry, now) * 3600, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Protect every branch matching the rules of the ini files")
+    parser.add_argument("--force", action="store_true", help="renew the existing protections too")
+    parser.add_argument("--dry-run", action="store_true", help="print the changes instead of sending them")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="calls in flight at most")
+    args = parser.parse_args()
+    # imported here : the application module is only needed by the command line job
+    from app import FlaskHook
+    hooks = FlaskHook()
+    engine = ReconcileEngine(hooks.handlers, force=args.force, concurrency=args.concurrency)
+    if args.dry_run:
+        print(json.dumps(engine.dry_run(), indent=2))
+        return
+    report = engine.run()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Module keeping the listing pages fetched from Gitea, revalidated with conditional requests"""
+import collections
+import gzip
+import json
+import os
+import tempfile
+import threading
+import logging
+from time import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from scripts.http_client import get_client
+from scripts.metrics import REGISTRY, cache_lookup
+
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+# Response headers replayed with a cached page, the pagination depends on them
+KEPT_HEADERS = ("Content-Type", "Link", "X-Total-Count")
+
+
+class ResponseCache:
+    """LRU of the pages keyed by url and query, bounded by the size of their bodies
+
+    A known page is requested with If-None-Match / If-Modified-Since, a 304 is answered with the stored body.
+    Only the pages the server sent a validator for are kept.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, filename=None):
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.lock = threading.Lock()
+        # key -> (etag, last modified, kept headers, body)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.dirty = False
+
+    @staticmethod
+    def key(url, params=None):
+        return url + "?" + urlencode(sorted((params or {}).items())) if params else url
+
+    def validators(self, key):
+        """Conditional headers for a known page"""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry[0]:
+            headers["If-None-Match"] = entry[0]
+        if entry[1]:
+            headers["If-Modified-Since"] = entry[1]
+        return headers
+
+    def refresh(self, key, response):
+        """Stored entry of a page answered 304, updated with the headers the 304 carries
+
+        The body did not change but the pagination may have : a branch added on another page changes the count.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            headers = dict(entry[2], **{name: response.headers[name] for name in KEPT_HEADERS
+                                        if name in response.headers and name != "Content-Type"})
+            if headers != entry[2]:
+                entry = (response.headers.get("ETag") or entry[0], response.headers.get("Last-Modified") or entry[1],
+                         headers, entry[3])
+                self.entries[key] = entry
+                self.dirty = True
+            self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, response):
+        """Keep a 200 answer carrying a validator, evicting the least recently used pages past the budget"""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        body = response.content
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[3])
+            if not (etag or last_modified) or len(body) > self.max_bytes:
+                return
+            headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+            self.entries[key] = (etag, last_modified, headers, body)
+            self.size += len(body)
+            self.dirty = True
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1][3])
+                self.evicted += 1
+
+    @staticmethod
+    def replay(url, entry):
+        """Response rebuilt from a stored page, as if the server had sent it again"""
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry[2])
+        response._content = entry[3]  # pylint: disable=protected-access
+        response.from_cache = True
+        return response
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        """GET through the shared client, a 304 is turned into the stored 200"""
+        key = self.key(url, params)
+        conditional = dict(headers or {}, **self.validators(key))
+        response = get_client().get(url, params=params, headers=conditional, **kwargs)
+        if response.status_code == 304:
+            entry = self.refresh(key, response)
+            if entry is not None:
+                self.hits += 1
+                cache_lookup("response", True)
+                return self.replay(response.url or url, entry)
+            # evicted in the meantime : ask again without the validators
+            response = get_client().get(url, params=params, headers=headers, **kwargs)
+        self.misses += 1
+        cache_lookup("response", False)
+        response.from_cache = False
+        if response.status_code == 200:
+            self.store(key, response)
+        return response
+
+    def save(self, filename=None):
+        """Atomically write the pages to a gzipped JSON-lines file : a header, then one page per line"""
+        filename = filename or self.filename
+        if not filename:
+            return
+        with self.lock:
+            entries = list(self.entries.items())
+            self.dirty = False
+        header = {"version": CACHE_VERSION, "saved_at": time(), "count": len(entries)}
+        # a temporary file of its own : the periodic save and the one at exit may overlap
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                                 prefix=os.path.basename(filename) + ".", suffix=".tmp")
+        try:
+            with open(descriptor, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8", compresslevel=1) as saving:
+                saving.write(json.dumps(header) + "\n")
+                for key, (etag, last_modified, headers, body) in entries:
+                    saving.write(json.dumps([key, etag, last_modified, headers, body.decode("utf-8")]) + "\n")
+            os.replace(temporary, filename)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        log.debug("Written %s cached pages to %s", len(entries), filename)
+
+    def load(self, filename=None):
+        """Read the pages written by save, a missing or unreadable file leaves the cache empty"""
+        filename = filename or self.filename
+        if not filename or not os.path.isfile(filename):
+            return
+        try:
+            with gzip.open(filename, "rt", encoding="utf-8") as reading:
+                header = json.loads(reading.readline() or "null")
+                if not isinstance(header, dict) or header.get("version") != CACHE_VERSION:
+                    raise ValueError("unsupported cache {}".format(filename))
+                entries = [json.loads(line) for line in reading if line.strip()]
+        except (OSError, ValueError, EOFError) as e:
+            log.warning("Ignoring the response cache %s : %s", filename, e)
+            return
+        with self.lock:
+            for key, etag, last_modified, headers, body in entries:
+                body = body.encode("utf-8")
+                self.entries[key] = (etag, last_modified, headers, body)
+                self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1][3])
+        log.info("Loaded %s cached pages from %s", len(self.entries), filename)
+
+    def flush(self):
+        """Write the pages if new ones were stored since the last save"""
+        if self.dirty:
+            self.save()
+
+    def stats(self):
+        return {"pages": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                "not_modified": self.hits, "fetched": self.misses, "evicted": self.evicted}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process wide cache, sized by GITEA_CACHE_MAX_BYTES and stored in GITEA_CACHE_FILE"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                cache = ResponseCache(
+                    max_bytes=int(os.environ.get("GITEA_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+                    filename=os.environ.get("GITEA_CACHE_FILE", "gitea_cache.jsonl.gz"),
+                )
+                cache.load()
+                REGISTRY.gauge("gitea_response_cache_bytes", "Size of the listing pages kept for revalidation",
+                               callback=lambda: cache.size)
+                _cache = cache
+    return _cache
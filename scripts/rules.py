@@ -0,0 +1,88 @@
+"""Module compiling the branch rules of a repository once, so branches can be matched in bulk"""
+import ast
+import re
+
+# Characters that turn a rule into a real regex, anything else is matched as a plain prefix
+_REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+# Backreferences and conditional groups (?(1)...) are numbered per pattern, they cannot be merged into one alternation
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+_END = object()
+
+
+class PrefixTrie:
+    """Trie of literal rules, re.match on a literal is a startswith"""
+    def __init__(self, prefixes=()):
+        self.root = {}
+        self.size = 0
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if _END not in node:
+            node[_END] = True
+            self.size += 1
+
+    def match(self, branch):
+        """True if one of the prefixes starts the branch"""
+        node = self.root
+        if _END in node:
+            return True
+        for char in branch:
+            node = node.get(char)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
+
+
+class BranchRules:
+    """Precompiled matcher for the "branches" option of a repository section"""
+    def __init__(self, rules):
+        self.rules = list(rules)
+        literals = []
+        patterns = []
+        for rule in self.rules:
+            literal = rule[1:] if rule.startswith("^") else rule
+            if not _REGEX_CHARS.intersection(literal):
+                literals.append(literal)
+            else:
+                patterns.append(rule)
+        self.prefixes = PrefixTrie(literals)
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.combined = self.combine(patterns)
+
+    @classmethod
+    def from_config(cls, repo_parameters):
+        """Build the matcher from the literal list stored in the ini file"""
+        return cls(ast.literal_eval(repo_parameters["branches"]))
+
+    @staticmethod
+    def combine(patterns):
+        """Merge the regexes into a single alternation when it keeps the same meaning"""
+        if not patterns or any(_BACKREFERENCE.search(pattern) for pattern in patterns):
+            return None
+        try:
+            return re.compile("|".join("(?:{})".format(pattern) for pattern in patterns))
+        except re.error:
+            # inline global flags or duplicated group names : keep them separated
+            return None
+
+    def match(self, branch):
+        """Same answer as re.match on every rule, in one pass"""
+        if self.prefixes.size and self.prefixes.match(branch):
+            return True
+        if self.combined is not None:
+            return self.combined.match(branch) is not None
+        for pattern in self.patterns:
+            if pattern.match(branch):
+                return True
+        return False
+
+    def match_many(self, branches):
+        """Return the set of branches concerned by the rules"""
+        match = self.match
+        return {branch for branch in branches if match(branch)}
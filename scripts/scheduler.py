@@ -0,0 +1,141 @@
+"""Module running the protection tasks on a fixed pool of workers"""
+import collections
+import threading
+from time import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler cannot take more tasks"""
+
+
+class TaskScheduler:
+    """Bounded, deduplicated and per-repository fair task queue served by a fixed set of threads
+
+    A task is identified by a key (repository, branch) : submitting a key which is already waiting
+    is a no-op, so repeated pushes to one branch collapse into one protection call.
+    Repositories are served round-robin, a repository with thousands of tasks cannot starve the others.
+    """
+    def __init__(self, workers=8, max_pending=10000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        # repository -> deque of (key, function, enqueued_at)
+        self.queues = {}
+        # repositories having waiting tasks, in serving order
+        self.ready = collections.deque()
+        self.pending = set()
+        self.running = 0
+        self.threads = []
+        self.stopped = False
+        self.stats = {"submitted": 0, "deduplicated": 0, "rejected": 0, "completed": 0, "failed": 0,
+                      "wait_total": 0.0, "run_total": 0.0, "wait_max": 0.0, "run_max": 0.0}
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.work, name="scheduler-{}".format(number), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def submit(self, repository, key, function, block=False):
+        """Queue function under key, return False if the key was already waiting
+
+        When the queue is full, raise QueueFull, or wait for room if block is set.
+        """
+        with self.condition:
+            if key in self.pending:
+                self.stats["deduplicated"] += 1
+                return False
+            if block:
+                self.condition.wait_for(lambda: len(self.pending) < self.max_pending or self.stopped)
+            if len(self.pending) >= self.max_pending:
+                self.stats["rejected"] += 1
+                raise QueueFull("{} tasks already waiting".format(len(self.pending)))
+            queue = self.queues.get(repository)
+            if queue is None:
+                queue = self.queues[repository] = collections.deque()
+                self.ready.append(repository)
+            queue.append((key, function, time()))
+            self.pending.add(key)
+            self.stats["submitted"] += 1
+            self.condition.notify_all()
+            return True
+
+    def next_task(self):
+        """Pop the oldest task of the next repository, None when stopping"""
+        with self.condition:
+            while not self.ready and not self.stopped:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            repository = self.ready.popleft()
+            queue = self.queues[repository]
+            key, function, enqueued_at = queue.popleft()
+            if queue:
+                self.ready.append(repository)
+            else:
+                del self.queues[repository]
+            # the key stays pending while it runs : submitting it again meanwhile is a duplicate
+            self.running += 1
+            return key, function, enqueued_at
+
+    def work(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+            key, function, enqueued_at = task
+            started = time()
+            failed = False
+            try:
+                function()
+            except Exception as e:
+                failed = True
+                log.error("Task %s failed : %s", key, e)
+            finished = time()
+            with self.condition:
+                self.pending.discard(key)
+                self.running -= 1
+                self.record(started - enqueued_at, finished - started, failed)
+                self.condition.notify_all()
+
+    def record(self, wait, run, failed):
+        stats = self.stats
+        stats["failed" if failed else "completed"] += 1
+        stats["wait_total"] += wait
+        stats["run_total"] += run
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        stats["run_max"] = max(stats["run_max"], run)
+
+    def depth(self):
+        return len(self.pending)
+
+    def has_room(self, reserved=0):
+        """True if reserved more tasks could still be queued after the waiting ones"""
+        with self.condition:
+            return len(self.pending) + reserved < self.max_pending
+
+    def wait_idle(self, timeout=None):
+        """Block until every queued task ran, return False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.running, timeout)
+
+    def snapshot(self):
+        """Queue depth and latency stats, as a dict"""
+        with self.condition:
+            stats = dict(self.stats)
+            done = stats["completed"] + stats["failed"]
+            stats["depth"] = len(self.pending)
+            stats["running"] = self.running
+            stats["repositories_waiting"] = len(self.queues)
+            stats["wait_avg"] = stats["wait_total"] / done if done else 0.0
+            stats["run_avg"] = stats["run_total"] / done if done else 0.0
+            return stats
@@ -0,0 +1,203 @@
+"""Module sharing the state of the service between the worker processes of a multi-process deployment
+
+Every worker keeps its branch indexes in memory and publishes its changes to a change log in a SQLite
+database in WAL mode, the other workers replay it. The delivery ids and the pending protection tasks live
+in the same database, with a heartbeat per worker, and a file lock elects the worker driving the background
+reconciles.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import logging
+from time import time
+
+from scripts.metrics import cache_lookup
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (id TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS deliveries_seen_at ON deliveries (seen_at);
+CREATE TABLE IF NOT EXISTS tasks (repository TEXT NOT NULL, branch TEXT NOT NULL, worker TEXT NOT NULL,
+                                  queued_at REAL NOT NULL, PRIMARY KEY (repository, branch));
+CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL,
+                                   repository TEXT NOT NULL, kind TEXT NOT NULL, branch TEXT NOT NULL,
+                                   data TEXT, at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, beat_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS listings (organization TEXT PRIMARY KEY, repositories TEXT NOT NULL, at REAL NOT NULL);
+"""
+
+
+class SharedStore:
+    """SQLite database in WAL mode, one connection per thread"""
+    def __init__(self, filename, worker=None):
+        self.filename = filename
+        self.worker = worker or "{}-{}".format(os.uname().nodename, os.getpid())
+        self.local = threading.local()
+        self.connect().executescript(SCHEMA)
+        # the log written before this worker started is already in the snapshots
+        self.last_seq = self.connect().execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+        self.beat()
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # autocommit : every statement is its own short transaction
+            connection = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def seen(self, delivery, ttl):
+        """True if a worker already received delivery during the last ttl seconds, otherwise remember it"""
+        now = time()
+        connection = self.connect()
+        inserted = connection.execute("INSERT OR IGNORE INTO deliveries (id, seen_at) VALUES (?, ?)",
+                                      (delivery, now)).rowcount
+        if inserted:
+            return False
+        # an expired id is received again
+        return not connection.execute("UPDATE deliveries SET seen_at = ? WHERE id = ? AND seen_at < ?",
+                                      (now, delivery, now - ttl)).rowcount
+
+    def forget_delivery(self, delivery):
+        self.connect().execute("DELETE FROM deliveries WHERE id = ?", (delivery,))
+
+    def claim_task(self, repository, branch):
+        """Record a pending protection, False if a worker already has it pending"""
+        return bool(self.connect().execute(
+            "INSERT OR IGNORE INTO tasks (repository, branch, worker, queued_at) VALUES (?, ?, ?, ?)",
+            (repository, branch, self.worker, time())).rowcount)
+
+    def release_task(self, repository, branch):
+        self.connect().execute("DELETE FROM tasks WHERE repository = ? AND branch = ?", (repository, branch))
+
+    def beat(self):
+        """Tell the other workers this one is alive"""
+        self.connect().execute("INSERT OR REPLACE INTO workers (worker, beat_at) VALUES (?, ?)", (self.worker, time()))
+
+    def adopt_tasks(self, timeout):
+        """Take over the tasks of the workers which did not beat for timeout seconds : they died
+
+        A live worker keeps its tasks, however long they wait in its queue.
+        """
+        now = time()
+        orphans = ("worker != ? AND worker NOT IN (SELECT worker FROM workers WHERE beat_at >= ?)")
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            tasks = connection.execute("SELECT repository, branch FROM tasks WHERE " + orphans,
+                                       (self.worker, now - timeout)).fetchall()
+            connection.execute("UPDATE tasks SET worker = ?, queued_at = ? WHERE " + orphans,
+                               (self.worker, now, self.worker, now - timeout))
+            connection.execute("DELETE FROM workers WHERE worker != ? AND beat_at < ?", (self.worker, now - timeout))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return tasks
+
+    def share_listing(self, organization, repositories):
+        """Record the repositories found in an organization for the other workers, True if they changed"""
+        data = json.dumps(repositories)
+        connection = self.connect()
+        changed = connection.execute(
+            "UPDATE listings SET repositories = ?, at = ? WHERE organization = ? AND repositories != ?",
+            (data, time(), organization, data)).rowcount
+        changed += connection.execute("INSERT OR IGNORE INTO listings (organization, repositories, at) VALUES (?, ?, ?)",
+                                      (organization, data, time())).rowcount
+        return bool(changed)
+
+    def listing(self, organization):
+        """Repositories of an organization recorded by share_listing, None if it was never scanned"""
+        row = self.connect().execute("SELECT repositories FROM listings WHERE organization = ?",
+                                     (organization,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def publish(self, repository, kind, branch="", data=None):
+        """Append a change of a branch index to the log replayed by the other workers"""
+        self.connect().execute(
+            "INSERT INTO events (worker, repository, kind, branch, data, at) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.worker, repository, kind, branch, None if data is None else json.dumps(data), time()))
+
+    def changes(self, limit=10000):
+        """Changes published by the other workers since the last call, as (repository, kind, branch, data)"""
+        rows = self.connect().execute(
+            "SELECT seq, worker, repository, kind, branch, data FROM events WHERE seq > ? ORDER BY seq LIMIT ?",
+            (self.last_seq, limit)).fetchall()
+        if rows:
+            self.last_seq = rows[-1][0]
+        return [(repository, kind, branch, None if data is None else json.loads(data))
+                for _, worker, repository, kind, branch, data in rows if worker != self.worker]
+
+    def prune(self, events_age, deliveries_age):
+        """Forget the changes replayed long ago and the expired delivery ids"""
+        now = time()
+        connection = self.connect()
+        connection.execute("DELETE FROM events WHERE at < ?", (now - events_age,))
+        connection.execute("DELETE FROM deliveries WHERE seen_at < ?", (now - deliveries_age,))
+
+    def stats(self):
+        connection = self.connect()
+        return {"worker": self.worker,
+                "pending_tasks": connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0],
+                "workers": connection.execute("SELECT COUNT(*) FROM workers").fetchone()[0],
+                "deliveries": connection.execute("SELECT COUNT(*) FROM deliveries").fetchone()[0],
+                "replayed_up_to": self.last_seq}
+
+
+class SharedDeliveryCache:
+    """DeliveryCache of every worker, stored in the shared database"""
+    def __init__(self, store, ttl=3600):
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, delivery):
+        """True if delivery was already received by any worker. Events without id are never duplicates"""
+        if not delivery:
+            return False
+        if self.store.seen(delivery, self.ttl):
+            self.hits += 1
+            cache_lookup("delivery", True)
+            return True
+        self.misses += 1
+        cache_lookup("delivery", False)
+        return False
+
+    def forget(self, delivery):
+        """Drop a delivery which was not accepted after all, so that the retry of Gitea is"""
+        if delivery:
+            self.store.forget_delivery(delivery)
+
+    def stats(self):
+        return {"shared": True, "deduplicated": self.hits, "accepted": self.misses}
+
+
+class LeaderLock:
+    """Exclusive lock on a file, held by one process until it exits : the kernel releases it if it dies"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.handle = None
+
+    @property
+    def held(self):
+        return self.handle is not None
+
+    def acquire(self):
+        """Try to take the lock without waiting, True if this process holds it"""
+        if self.handle is not None:
+            return True
+        handle = open(self.filename, "a+")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False
+        self.handle = handle
+        log.info("Worker %s leads the background reconciles", os.getpid())
+        return True